@@ -0,0 +1,511 @@
+import tkinter as tk
+import customtkinter as ctk
+import time
+import traceback
+
+debug_mode = False
+
+ITEM_PADDING = 10
+# Screens of content kept realized above and below the visible part of the chat
+OVERSCAN_SCREENS = 1.0
+# Idle widgets kept per item kind for reuse
+POOL_SIZE = 12
+LINE_HEIGHT = 18
+CHAR_WIDTH = 7
+RESIZE_DEBOUNCE_MS = 120
+# Horizontal space taken by the prefix / box padding next to wrapped text
+MESSAGE_WRAP_MARGIN = 60
+BOX_WRAP_MARGIN = 80
+
+class ChatItem:
+    """ One entry of the chat transcript. The model is all that is kept for every message; widgets
+        showing it only exist (in info) while the item is near the viewport.
+    """
+    __slots__ = ("kind", "data", "height", "measured", "info")
+
+    def __init__(self, kind, data):
+        self.kind = kind
+        self.data = data
+        self.height = 0
+        self.measured = False
+        self.info = None
+
+class StyleCache:
+    """ Fonts and per-theme tag styles for the chat, built once and shared by every widget, so a theme
+        switch swaps a cached style set instead of allocating new fonts.
+    """
+
+    def __init__(self):
+        self.fonts = None
+        self._tag_configs = {}
+
+    def get_fonts(self, base_font):
+        """The shared fonts, derived once from the input box font (a CTkFont or a (family, size) tuple)."""
+        if self.fonts is None:
+            base_family = "Arial"
+            base_size = 12
+            if isinstance(base_font, ctk.CTkFont):
+                 base_family = base_font.cget("family")
+                 base_size = base_font.cget("size")
+            elif isinstance(base_font, (tuple, list)) and len(base_font) >= 2:
+                base_family = base_font[0]; base_size = int(base_font[1])
+
+            self.fonts = {
+                "bold": ctk.CTkFont(family=base_family, size=base_size, weight="bold"),
+                "monospace": ctk.CTkFont(family="monospace", size=base_size -1),
+                "default": ctk.CTkFont(family=base_family, size=base_size),
+                "title": ctk.CTkFont(weight="bold")
+            }
+        return self.fonts
+
+    def get_tag_configs(self, theme_name, theme, base_font):
+        """Text styles (font and color) per tag for a theme, built on first use of that theme."""
+        tag_configs = self._tag_configs.get(theme_name)
+        if tag_configs is None:
+            fonts = self.get_fonts(base_font)
+            answer_fg = theme.get("answer_fg_color", "green")
+            text_fg = theme.get("text_box_fg", "#FFFFFF") 
+            tag_configs = self._tag_configs[theme_name] = {
+                "user_prefix": {"font": fonts["bold"], "text_color": theme.get("btn_color", "blue")},
+                "ai_prefix": {"font": fonts["bold"], "text_color": theme.get("btn_hover_color", "lightblue")},
+                "answer_text": {"text_color": answer_fg, "font": fonts["default"]},
+                "latex_text": {"text_color": text_fg, "font": fonts["monospace"]}, 
+                "latex_answer_text": {"text_color": answer_fg, "font": fonts["monospace"]}, 
+                "error_text": {"text_color": theme.get("error_fg_color", "red"), "font": fonts["default"]},
+                "default_text": {"text_color": text_fg, "font": fonts["default"]},
+                "code_text": {"font": fonts["monospace"], "text_color": theme.get("code_fg", text_fg)}
+            }
+            if debug_mode: print(f"DEBUG (ChatView): Built styles for theme '{theme_name}'.")
+        return tag_configs
+
+class ResizeManager:
+    """ Coalesces the <Configure> events of a widget: callback(width, height) runs once the size has
+        stopped changing for delay_ms, and only if it differs from the last size reported.
+    """
+
+    def __init__(self, widget, callback, delay_ms=RESIZE_DEBOUNCE_MS):
+        self.widget = widget
+        self.callback = callback
+        self.delay_ms = delay_ms
+        self.size = None
+        self._pending_size = None
+        self._timer_id = None
+        widget.bind("<Configure>", self._on_configure, add="+")
+
+    def _on_configure(self, event):
+        self._pending_size = (event.width, event.height)
+        if self._timer_id is not None:
+            self.widget.after_cancel(self._timer_id)
+        self._timer_id = self.widget.after(self.delay_ms, self._settle)
+
+    def _settle(self):
+        self._timer_id = None
+        if self._pending_size == self.size:
+            return
+        self.size = self._pending_size
+        self.callback(*self.size)
+
+class ChatView:
+    """ Virtualized chat transcript inside a CTkScrollableFrame. Only the items within about one
+        screen of the viewport have widgets; everything above and below is stood in for by two
+        spacer frames sized from measured (or estimated) item heights. Widgets leaving the window
+        are recycled per kind and refilled from the model when other items scroll in.
+    """
+
+    def __init__(self, owner, frame):
+        self.owner = owner
+        self.frame = frame
+        self.items = []
+        self._realized = []
+        self._pending = []
+        self._pools = {}
+        self._flush_id = None
+        self.last_render = None
+        self.styles = StyleCache()
+        self._refresh_id = None
+        self._measure_id = None
+
+        self.top_spacer = tk.Frame(frame, height=0, highlightthickness=0, bd=0)
+        self.bottom_spacer = tk.Frame(frame, height=0, highlightthickness=0, bd=0)
+        self.top_spacer.pack(fill="x")
+        self.bottom_spacer.pack(fill="x")
+
+        self.canvas = frame._parent_canvas
+        self.scrollbar = getattr(frame, "_scrollbar", None)
+        self.canvas.configure(yscrollcommand=self._on_yscroll)
+        self.wrap_width = None
+        self.resize_manager = ResizeManager(self.canvas, self._on_resize)
+
+    # --- model ---
+
+    def add(self, kind, **data):
+        """ Appends an item to the transcript and returns it. Its widgets are built with the rest of
+            the batch in one idle callback, which then scrolls to the end.
+        """
+        item = ChatItem(kind, data)
+        item.height = self._estimate_height(item)
+        self.items.append(item)
+        self._pending.append(item)
+        if self._flush_id is None:
+            self._flush_id = self.owner.after_idle(self._flush)
+        return item
+
+    def _flush(self):
+        """Builds every item queued since the last batch with one layout pass and one scroll."""
+        self._flush_id = None
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        started = time.perf_counter()
+
+        first_new = self.items.index(pending[0])
+        last = len(self.items) - 1
+        if self._realized and first_new > 0 and self._realized[-1] is self.items[first_new - 1]:
+            first = self.items.index(self._realized[0])
+        else:
+            first = first_new
+        self._set_window(first, last)
+        self.frame.update_idletasks()
+        self._measure()
+        self.scroll_to_end()
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.last_render = {"items": len(pending), "ms": elapsed_ms}
+        if debug_mode: print(f"DEBUG (ChatView): Rendered batch of {len(pending)} item(s) in {elapsed_ms:.1f} ms.")
+
+    def update_text(self, item, text):
+        """Replaces an item's text (e.g. a response that is still streaming in)."""
+        item.data["text"] = text
+        item.measured = False
+        if item.info:
+            self._fill(item.info, item)
+            self._schedule_measure()
+
+    def remove(self, item):
+        if item not in self.items:
+            return
+        if item in self._pending:
+            self._pending.remove(item)
+        if item.info:
+            self._unrealize(item)
+            self._realized.remove(item)
+        self.items.remove(item)
+        self._update_spacers()
+        self._schedule_refresh()
+
+    def clear(self):
+        for item in self._realized:
+            self._unrealize(item)
+        self._realized = []
+        self._pending = []
+        self.items = []
+        self._update_spacers()
+
+    def scroll_to_end(self):
+        self.canvas.yview_moveto(1.0)
+
+    def restyle(self):
+        """Re-applies the current theme to the spacers and the realized widgets; pooled widgets are styled when reused."""
+        theme = self.owner.current_theme_settings
+        for spacer in (self.top_spacer, self.bottom_spacer):
+            spacer.configure(bg=theme.get("text_box_bg"))
+        for item in self._realized:
+            try:
+                self._apply_style(item.info, item)
+            except Exception as e:
+                print(f"ERROR: Failed to reapply theme to chat item: {e}")
+                if debug_mode: traceback.print_exc()
+        self._schedule_measure()
+
+    # --- windowing ---
+
+    def _get_wrap_width(self):
+        if not self.wrap_width:
+            width = self.canvas.winfo_width()
+            if width <= 1:
+                return max(self.frame.winfo_width(), 1)
+            self.wrap_width = width
+        return self.wrap_width
+
+    def _on_resize(self, width, height):
+        """Re-wraps the realized widgets once per settled size; other items are re-measured when they scroll in."""
+        if width == self.wrap_width:
+            self._schedule_refresh()
+            return
+        self.wrap_width = width
+        for item in self.items:
+            if item.info is None:
+                item.measured = False
+                item.height = self._estimate_height(item)
+        for item in self._realized:
+            item.measured = False
+            self._apply_wrap(item.info)
+        if debug_mode: print(f"DEBUG (ChatView): Re-wrapped {len(self._realized)} realized item(s) at width {width}.")
+        self._update_spacers()
+        self._schedule_measure()
+        self._schedule_refresh()
+
+    def _apply_wrap(self, info):
+        if info["type"] == "message_label":
+            info["content_widget"].configure(wraplength=self._get_wrap_width() - MESSAGE_WRAP_MARGIN)
+        elif info["type"] == "titled_box":
+            info["content_widget"].configure(wraplength=self._get_wrap_width() - BOX_WRAP_MARGIN)
+
+    def _on_yscroll(self, first, last):
+        if self.scrollbar:
+            self.scrollbar.set(first, last)
+        self._schedule_refresh()
+
+    def _schedule_refresh(self):
+        if self._refresh_id is None:
+            self._refresh_id = self.owner.after_idle(self._refresh)
+
+    def _schedule_measure(self):
+        if self._measure_id is None:
+            self._measure_id = self.owner.after_idle(self._measure)
+
+    def _refresh(self):
+        """Realizes the items around the viewport and releases the rest."""
+        self._refresh_id = None
+        if not self.items:
+            return
+
+        viewport = max(self.canvas.winfo_height(), 1)
+        top_fraction, bottom_fraction = self.canvas.yview()
+        total = sum(item.height for item in self.items)
+        margin = viewport * OVERSCAN_SCREENS
+        low, high = top_fraction * total - margin, bottom_fraction * total + margin
+
+        first, last, position = None, 0, 0
+        for index, item in enumerate(self.items):
+            if position + item.height >= low and first is None:
+                first = index
+            if position <= high:
+                last = index
+            else:
+                break
+            position += item.height
+        first = min(first if first is not None else len(self.items) - 1, last)
+
+        if self._realized and self._realized[0] is self.items[first] and self._realized[-1] is self.items[last]:
+            return
+        self._set_window(first, last)
+
+    def _set_window(self, first, last):
+        keep = self.items[first:last + 1]
+        keep_ids = {id(item) for item in keep}
+        for item in self._realized:
+            if id(item) not in keep_ids:
+                self._unrealize(item)
+
+        before = self.bottom_spacer
+        for item in reversed(keep):
+            if item.info is None:
+                self._realize(item, before)
+            before = item.info["widget"]
+        self._realized = keep
+        self._update_spacers()
+        self._schedule_measure()
+        if debug_mode: print(f"DEBUG (ChatView): Realized items {first}-{last} of {len(self.items)}.")
+
+    def _update_spacers(self):
+        if self._realized:
+            first = self.items.index(self._realized[0])
+            last = first + len(self._realized) - 1
+        else:
+            first, last = len(self.items), len(self.items) - 1
+        self.top_spacer.configure(height=sum(item.height for item in self.items[:first]))
+        self.bottom_spacer.configure(height=sum(item.height for item in self.items[last + 1:]))
+
+    def _measure(self):
+        """Records the real height of realized items so spacers stand in for them accurately later."""
+        self._measure_id = None
+        changed = False
+        for item in self._realized:
+            height = item.info["widget"].winfo_height()
+            if height > 1 and height + ITEM_PADDING != item.height:
+                item.height = height + ITEM_PADDING
+                changed = True
+            item.measured = item.measured or height > 1
+        if changed:
+            self._update_spacers()
+
+    def _estimate_height(self, item):
+        """Height guess for an item that has never been realized."""
+        data = item.data
+        if item.kind == "code_block":
+            return min(300, max(60, len(data["code"].splitlines()) * 15 + 20)) + 10 + ITEM_PADDING
+        if item.kind == "cache_marker":
+            return 28 + ITEM_PADDING
+
+        chars_per_line = max(20, (self._get_wrap_width() - BOX_WRAP_MARGIN) // CHAR_WIDTH)
+        lines = sum(max(1, -(-len(line) // chars_per_line)) for line in data["text"].splitlines() or [""])
+        height = lines * LINE_HEIGHT + ITEM_PADDING
+        if item.kind == "titled_box":
+            height += 28 + 24
+        return height
+
+    # --- widgets ---
+
+    def _realize(self, item, before):
+        pool = self._pools.get(item.kind)
+        info = pool.pop() if pool else self._build(item.kind)
+        self._fill(info, item)
+        info["widget"].pack(pady=(5, 5), padx=5, fill="x", expand=False, before=before)
+        item.info = info
+
+    def _unrealize(self, item):
+        info, item.info = item.info, None
+        info["item"] = None
+        info["widget"].pack_forget()
+        pool = self._pools.setdefault(item.kind, [])
+        if len(pool) < POOL_SIZE:
+            pool.append(info)
+            return
+        try:
+            info["widget"].destroy()
+        except tk.TclError as e:
+            print(f"Warning: Error destroying chat widget: {e}")
+
+    def _build(self, kind):
+        if kind == "message_label":
+            return self._build_message()
+        if kind == "titled_box":
+            return self._build_titled_box()
+        if kind == "code_block":
+            return self._build_code_block()
+        return self._build_cache_marker()
+
+    def _fill(self, info, item):
+        """Shows item's content in recycled widgets, restyling them only if they were styled differently."""
+        info["item"] = item
+        data = item.data
+        if item.kind == "message_label":
+            info["prefix_widget"].configure(text="You: " if data["role"].lower() == "user" else "AI: ")
+            info["content_widget"].configure(text=data["text"])
+        elif item.kind == "titled_box":
+            info["title_widget"].configure(text=data["title"])
+            info["content_widget"].configure(text=data["text"])
+        elif item.kind == "code_block":
+            code = data["code"]
+            code_textbox = info["textbox_widget"]
+            code_textbox.configure(state="normal", height=min(300, max(60, len(code.splitlines()) * 15 + 20)))
+            code_textbox.delete("1.0", tk.END)
+            code_textbox.insert("1.0", code)
+            code_textbox.configure(state="disabled")
+        else:
+            info["label_widget"].configure(text=data["text"])
+        self._apply_wrap(info)
+        self._apply_style(info, item)
+
+    def _apply_style(self, info, item):
+        """Applies the current theme's shared styles to info's widgets unless they already carry them."""
+        theme = self.owner.current_theme_settings
+        style_key = (id(theme), item.data.get("role"), item.data.get("style_tag"))
+        if info.get("style_key") == style_key:
+            return
+        info["style_key"] = style_key
+
+        if item.kind == "message_label":
+            is_user = item.data["role"].lower() == "user"
+            prefix_config = self._tag_style("user_prefix" if is_user else "ai_prefix")
+            info["prefix_widget"].configure(font=prefix_config.get("font"), text_color=prefix_config.get("text_color"))
+            message_config = self._tag_style(item.data["style_tag"])
+            info["content_widget"].configure(font=message_config.get("font"), text_color=message_config.get("text_color"))
+
+        elif item.kind == "titled_box":
+            info["widget"].configure(fg_color=theme.get("text_box_bg"), border_color=theme.get("box_border_color"))
+            info["title_widget"].configure(fg_color=theme.get("box_title_bg"), text_color=theme.get("text_color"))
+            content_config = self._tag_style(item.data["style_tag"])
+            info["content_widget"].configure(font=content_config.get("font"), text_color=content_config.get("text_color"))
+            info["button_widget"].configure(
+                fg_color=theme.get("box_border_color"),
+                text_color=theme.get("text_box_bg"),
+                hover_color=theme.get("btn_hover_color")
+            )
+
+        elif item.kind == "code_block":
+            info["widget"].configure(fg_color=theme.get("code_bg"), border_color=theme.get("code_border"))
+            text_config = self._tag_style("code_text")
+            info["textbox_widget"].configure(
+                fg_color=theme.get("code_bg"),
+                text_color=text_config.get("text_color"),
+                font=text_config.get("font")
+            )
+            info["button_widget"].configure(
+                fg_color=theme.get("code_border"),
+                text_color=theme.get("code_bg"),
+                hover_color=theme.get("btn_hover_color")
+            )
+
+        else:
+            info["label_widget"].configure(text_color=theme.get("status_text_color", theme.get("text_color")))
+            info["button_widget"].configure(
+                fg_color=theme.get("btn_color"),
+                hover_color=theme.get("btn_hover_color"),
+                text_color=theme.get("btn_text_color", theme.get("text_color"))
+            )
+
+    def _copy_item_text(self, info, key):
+        if info["item"]:
+            self.owner._copy_to_clipboard(info["item"].data[key])
+
+    def _tag_style(self, tag):
+        tag_configs = self.owner.tag_configs
+        return tag_configs.get(tag, tag_configs["default_text"])
+
+    def _build_message(self):
+        msg_frame = ctk.CTkFrame(self.frame, fg_color="transparent")
+        msg_frame.grid_columnconfigure(1, weight=1)
+
+        prefix_label = ctk.CTkLabel(msg_frame, text="", anchor="nw")
+        prefix_label.grid(row=0, column=0, sticky="nw", padx=(0, 5))
+
+        message_label = ctk.CTkLabel(msg_frame, text="", justify="left")
+        message_label.grid(row=0, column=1, sticky="nw")
+        return {"type": "message_label", "widget": msg_frame, "prefix_widget": prefix_label, "content_widget": message_label}
+
+    def _build_titled_box(self):
+        box_frame = ctk.CTkFrame(self.frame, border_width=2, corner_radius=5)
+        box_frame.grid_columnconfigure(0, weight=1)
+
+        title_font = self.styles.get_fonts(self.owner.input_entry.cget("font"))["title"]
+        title_label = ctk.CTkLabel(box_frame, text="", font=title_font, anchor="w", corner_radius=0)
+        title_label.grid(row=0, column=0, sticky="ew", padx=0, pady=0)
+
+        content_label = ctk.CTkLabel(box_frame, text="", justify="left", anchor="nw")
+        content_label.grid(row=1, column=0, sticky="nw", padx=10, pady=10)
+
+        info = {"type": "titled_box", "widget": box_frame, "title_widget": title_label, "content_widget": content_label}
+        copy_button = ctk.CTkButton(box_frame, text="📋", width=30, height=30, command=lambda: self._copy_item_text(info, "text"))
+        copy_button.place(relx=1.0, rely=0.0, x=-5, y=5, anchor="ne")
+        info["button_widget"] = copy_button
+        return info
+
+    def _build_code_block(self):
+        code_frame = ctk.CTkFrame(self.frame, border_width=1, corner_radius=5)
+        code_frame.grid_columnconfigure(0, weight=1)
+        code_frame.grid_rowconfigure(0, weight=1)
+
+        code_textbox = ctk.CTkTextbox(code_frame, wrap="none", border_width=0, activate_scrollbars=True)
+        code_textbox.grid(row=0, column=0, sticky="nsew", padx=(5,0), pady=5)
+
+        info = {"type": "code_block", "widget": code_frame, "textbox_widget": code_textbox}
+        copy_button = ctk.CTkButton(code_frame, text="📋", width=30, height=30, command=lambda: self._copy_item_text(info, "code"))
+        copy_button.place(relx=1.0, rely=0.0, x=-5, y=5, anchor="ne")
+        info["button_widget"] = copy_button
+        return info
+
+    def _build_cache_marker(self):
+        marker_frame = ctk.CTkFrame(self.frame, fg_color="transparent")
+        marker_label = ctk.CTkLabel(marker_frame, text="", anchor="w")
+        marker_label.pack(side="left", padx=(0, 10))
+
+        info = {"type": "cache_marker", "widget": marker_frame, "label_widget": marker_label}
+        ask_button = ctk.CTkButton(
+            marker_frame, text="Ask AI instead", width=110, height=24,
+            command=lambda: info["item"] and info["item"].data["command"]()
+        )
+        ask_button.pack(side="left")
+        info["button_widget"] = ask_button
+        return info
@@ -0,0 +1,138 @@
+import argparse
+import json
+import queue
+import sys
+from core import RESPONSE_CACHE_FILE, ConversationEngine, PromptSet, TurnRecord, load_settings, set_debug_mode
+from providers import AsyncEngine, ProviderDispatcher, client_key
+from response_cache import ResponseCache, DEFAULT_CACHE_SIZE
+from server import DEFAULT_HOST, DEFAULT_PORT, serve
+
+debug_mode = False
+
+# API calls one question may take before it is given up on
+MAX_TOOL_TURNS = 8
+
+def read_questions(source, blocks=False):
+    """ Reads questions from a file ('-' for stdin): one per line, or separated by blank lines
+        when blocks is True so a question can span several lines.
+    """
+    if source == "-":
+        text = sys.stdin.read()
+    else:
+        with open(source, 'r', encoding='utf-8') as f:
+            text = f.read()
+    if blocks:
+        return [block.strip() for block in text.replace("\r\n", "\n").split("\n\n") if block.strip()]
+    return [line.strip() for line in text.splitlines() if line.strip()]
+
+def start_question(index, question, settings, prompts, dispatcher, engine, finished):
+    """ Starts one question on its own ConversationEngine. When its turn ends, the JSONL record
+        (see TurnRecord.to_dict) is put on finished.
+    """
+    conversation = ConversationEngine(settings, prompts, dispatcher, engine, max_requests_per_turn=MAX_TOOL_TURNS)
+    record = TurnRecord(conversation)
+
+    def on_event(event, **data):
+        if debug_mode and event == "error": print(f"DEBUG [Batch {index}]: {data['message']}", file=sys.stderr)
+        if record.add_event(event, **data):
+            finished.put({"index": index, "question": question, **record.to_dict()})
+
+    conversation.subscribe(on_event)
+    if not conversation.send(question):
+        record.fail("Could not format the system prompt.")
+        finished.put({"index": index, "question": question, **record.to_dict()})
+    return conversation
+
+def run_batch(args, settings, prompts):
+    questions = read_questions(args.questions, args.blocks)
+    if not questions:
+        print("No questions found.", file=sys.stderr)
+        return 1
+
+    workers = max(1, args.workers)
+    engine = AsyncEngine(max_concurrency=workers)
+    dispatcher = ProviderDispatcher(engine, coalescer=ResponseCache(None))
+    output = sys.stdout if args.output == "-" else open(args.output, 'w', encoding='utf-8')
+    pending = iter(enumerate(questions))
+    finished = queue.Queue()
+    active = {}
+    counts = {}
+
+    def start_next():
+        for index, question in pending:
+            active[index] = start_question(index, question, settings, prompts, dispatcher, engine, finished)
+            return
+
+    try:
+        for _ in range(workers):
+            start_next()
+        while active:
+            record = finished.get()
+            active.pop(record["index"], None)
+            start_next()
+            counts[record["status"]] = counts.get(record["status"], 0) + 1
+            output.write(json.dumps(record, ensure_ascii=False) + "\n")
+            output.flush()
+    except KeyboardInterrupt:
+        for conversation in active.values():
+            conversation.close()
+        print("Interrupted.", file=sys.stderr)
+        return 130
+    finally:
+        engine.shutdown(wait_for=dispatcher.reset())
+        if output is not sys.stdout:
+            output.close()
+
+    summary = ", ".join(f"{count} {status}" for status, count in sorted(counts.items()))
+    print(f"Finished {len(questions)} question(s): {summary}.", file=sys.stderr)
+    return 0 if counts.get("error", 0) < len(questions) else 1
+
+def run_server(args, settings, prompts):
+    engine = AsyncEngine(max_concurrency=max(1, args.workers))
+    response_cache = ResponseCache(RESPONSE_CACHE_FILE, settings.get("response_cache_size", DEFAULT_CACHE_SIZE))
+    dispatcher = ProviderDispatcher(engine, coalescer=response_cache)
+    dispatcher.client_registry.prewarm_async(*client_key(settings), keep_alive=settings.get("ollama_keep_alive"))
+    try:
+        serve(settings, prompts, dispatcher, engine, response_cache, host=args.host, port=args.port)
+    finally:
+        engine.shutdown(wait_for=dispatcher.reset())
+        response_cache.flush()
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run AnswerBot without the GUI: answer a file of questions as JSONL, or serve it over HTTP with --serve.")
+    parser.add_argument("questions", nargs="?", help="questions file, one question per line ('-' reads stdin)")
+    parser.add_argument("-o", "--output", default="-", help="JSONL output file (default: stdout)")
+    parser.add_argument("-w", "--workers", type=int, default=4, help="provider requests in flight at once (default: 4)")
+    parser.add_argument("--blocks", action="store_true", help="questions are separated by blank lines instead of one per line")
+    parser.add_argument("--serve", action="store_true", help="serve AnswerBot as a local HTTP/JSON API instead of answering a file")
+    parser.add_argument("--host", default=DEFAULT_HOST, help=f"address to serve on (default: {DEFAULT_HOST})")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"port to serve on (default: {DEFAULT_PORT})")
+    parser.add_argument("--api-type", choices=["OpenAI", "Gemini", "Ollama"], help="override the configured API type")
+    parser.add_argument("--model", help="override the configured model")
+    parser.add_argument("--endpoint", help="override the configured OpenAI or Ollama endpoint URL (e.g. a local mock backend; Ollama accepts a comma-separated list)")
+    parser.add_argument("--requests-per-minute", type=int, help="override the configured request budget shared by all workers")
+    parser.add_argument("--tokens-per-minute", type=int, help="override the configured token budget shared by all workers")
+    args = parser.parse_args(argv)
+    set_debug_mode(debug_mode)
+    if not args.serve and not args.questions:
+        parser.error("a questions file is required unless --serve is given")
+
+    settings = load_settings()
+    if args.api_type: settings["api_type"] = args.api_type
+    if args.model: settings["model"] = args.model
+    if args.endpoint:
+        settings["ollama_endpoint_url" if settings["api_type"] == "Ollama" else "openai_endpoint_url"] = args.endpoint
+    if args.requests_per_minute is not None: settings["requests_per_minute"] = args.requests_per_minute
+    if args.tokens_per_minute is not None: settings["tokens_per_minute"] = args.tokens_per_minute
+
+    prompts = PromptSet()
+    if not prompts.loaded:
+        print("Could not load required prompt files (SystemPrompt.txt, ResultPrompt.txt, UserPrompt.txt).", file=sys.stderr)
+        return 1
+    if args.serve:
+        return run_server(args, settings, prompts)
+    return run_batch(args, settings, prompts)
+
+if __name__ == "__main__":
+    sys.exit(main())
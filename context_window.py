@@ -0,0 +1,214 @@
+import re
+from message_log import Message, MessageLog, translate_message
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+debug_mode = False
+
+# Message kinds ConversationEngine tags protocol messages with (see Message.kind)
+TOOL_RESULT = "tool_result"        # user message carrying only successful tool results
+FAILED_RESULT = "failed_result"    # user message reporting a failed tool call or a format error
+FORMAT_ERROR = "format_error"      # assistant reply that could not be parsed as tool calls
+END_OF_TURN = "end_of_turn"        # assistant reply that only calls none_further
+
+# Context window sizes by model name prefix, most specific first; other models use the provider default
+MODEL_CONTEXT_WINDOWS = [
+    ("gpt-4.1", 1047576),
+    ("gpt-4o", 128000),
+    ("gpt-4-turbo", 128000),
+    ("gpt-4", 8192),
+    ("gpt-3.5-turbo", 16385),
+    ("o1", 200000),
+    ("o3", 200000),
+    ("o4", 200000),
+    ("gemini-1.0", 32760),
+    ("gemini-pro", 32760),
+    ("gemini", 1048576),
+]
+DEFAULT_CONTEXT_WINDOWS = {"OpenAI": 128000, "Gemini": 1048576, "Ollama": 8192}
+REPLY_RESERVE_TOKENS = 4096
+
+# Characters per token for estimating models without a local tokenizer
+CHARS_PER_TOKEN = {"OpenAI": 4.0, "Gemini": 4.0, "Ollama": 3.5}
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Compaction: the newest messages are never trimmed; older ones are clipped to CLIP_CHARS first
+KEEP_RECENT_MESSAGES = 4
+CLIP_CHARS = 2000
+SUMMARY_QUESTION_CHARS = 150
+SUMMARY_MAX_QUESTIONS = 10
+
+def context_window_size(api_type, model):
+    """Context window of model in tokens, from MODEL_CONTEXT_WINDOWS or the provider default."""
+    model = (model or "").lower()
+    for prefix, size in MODEL_CONTEXT_WINDOWS:
+        if model.startswith(prefix):
+            return size
+    return DEFAULT_CONTEXT_WINDOWS.get(api_type, 8192)
+
+def context_token_budget(settings):
+    """ Tokens the history sent to the provider may use: the "context_token_budget" setting, or when
+        that is 0 the model's context window less room for the reply.
+    """
+    budget = settings.get("context_token_budget", 0)
+    if budget and budget > 0:
+        return int(budget)
+    window = context_window_size(settings.get("api_type"), settings.get("model"))
+    return window - min(REPLY_RESERVE_TOKENS, window // 4)
+
+class TokenCounter:
+    """ Counts tokens for one model: with tiktoken's encoding for OpenAI models when it is installed,
+        otherwise with a characters-per-token estimate for the provider. Counts are cached per message.
+    """
+
+    def __init__(self, api_type, model):
+        self.name = f"tokens:{api_type}:{model}"
+        self.chars_per_token = CHARS_PER_TOKEN.get(api_type, 4.0)
+        self._encoding = None
+        if tiktoken and api_type == "OpenAI":
+            try:
+                self._encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                self._encoding = tiktoken.get_encoding("o200k_base")
+            except Exception as e:
+                if debug_mode: print(f"DEBUG (Context): No tiktoken encoding for {model}, estimating instead: {e}")
+
+    def count_text(self, text):
+        if not text:
+            return 0
+        if self._encoding:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        return int(len(text) / self.chars_per_token) + 1
+
+    def count(self, message):
+        return translate_message(message, self.name, lambda msg: self.count_text(str(msg.get("content") or "")) + MESSAGE_OVERHEAD_TOKENS)
+
+    def count_messages(self, messages):
+        return sum(self.count(message) for message in messages)
+
+def _head_length(messages):
+    """The opening messages that are always kept: the system message (if any) and the first question."""
+    return min(len(messages), 2 if messages and messages[0].role == "system" else 1)
+
+def collapse_protocol_chatter(messages):
+    """ Drops message pairs that no longer tell the model anything: a format error together with the
+        failure result it got once a later reply superseded it, and a successful tool result together
+        with a reply that only ended the turn. Pairs keep user and assistant turns alternating.
+    """
+    kept = []
+    index = 0
+    while index < len(messages):
+        message = messages[index]
+        following = messages[index + 1] if index + 1 < len(messages) else None
+        after = messages[index + 2] if index + 2 < len(messages) else None
+        if message.kind == FORMAT_ERROR and following is not None and following.kind == FAILED_RESULT and after is not None and after.role == "assistant":
+            index += 2
+        elif message.kind == TOOL_RESULT and following is not None and following.kind == END_OF_TURN:
+            index += 2
+        else:
+            kept.append(message)
+            index += 1
+    return kept
+
+def clip_message(message, max_chars=CLIP_CHARS):
+    """The message with its content cut to max_chars, keeping the start and the end."""
+    content = str(message.content or "")
+    if len(content) <= max_chars:
+        return message
+    head, tail = max_chars * 3 // 4, max_chars // 4
+    omitted = len(content) - head - tail
+    return Message(message.role, f"{content[:head]}\n[... {omitted} characters omitted ...]\n{content[-tail:]}", message.kind)
+
+def _question_text(message):
+    content = str(message.content or "")
+    match = re.search(r"<user_response>(.*?)</user_response>", content, re.DOTALL)
+    text = " ".join((match.group(1) if match else content).split())
+    return text if len(text) <= SUMMARY_QUESTION_CHARS else text[:SUMMARY_QUESTION_CHARS - 3] + "..."
+
+def summary_note(dropped):
+    """A short note standing in for dropped messages: how many there were and the user's questions among them."""
+    questions = [_question_text(message) for message in dropped if message.role == "user" and message.kind is None]
+    note = f"[Context note: {len(dropped)} earlier message(s) were left out to fit the context window."
+    if questions:
+        note += " Earlier user messages, oldest first:\n" + "\n".join(f"- {question}" for question in questions[-SUMMARY_MAX_QUESTIONS:])
+    return note + "]"
+
+def compact_history(messages, budget, counter):
+    """ Fits messages into budget tokens, least destructive step first: collapse protocol chatter,
+        clip long older messages, then drop the oldest turns after the opening messages, noting the
+        questions they held on the last opening message. Returns (messages, steps taken).
+    """
+    messages = list(messages)
+    steps = []
+    if counter.count_messages(messages) <= budget:
+        return messages, steps
+
+    collapsed = collapse_protocol_chatter(messages)
+    if len(collapsed) < len(messages):
+        steps.append(f"collapsed {len(messages) - len(collapsed)} protocol message(s)")
+        messages = collapsed
+        if counter.count_messages(messages) <= budget:
+            return messages, steps
+
+    head = _head_length(messages)
+    recent_start = max(head, len(messages) - KEEP_RECENT_MESSAGES)
+    clipped = messages[:head] + [clip_message(message) for message in messages[head:recent_start]] + messages[recent_start:]
+    if any(new is not old for new, old in zip(clipped, messages)):
+        steps.append("clipped long older messages")
+        messages = clipped
+        if counter.count_messages(messages) <= budget:
+            return messages, steps
+
+    opening, body = messages[:head], messages[head:]
+    opening_tokens = counter.count_messages(opening[:-1])
+    body_tokens = counter.count_messages(body)
+    dropped = []
+    noted = None
+    while len(body) > KEEP_RECENT_MESSAGES:
+        take = 2 if body[0].role == "assistant" and body[1].role == "user" else 1
+        dropped.extend(body[:take])
+        body_tokens -= counter.count_messages(body[:take])
+        body = body[take:]
+        last = opening[-1]
+        noted = Message(last.role, f"{last.content}\n\n{summary_note(dropped)}", last.kind)
+        if opening_tokens + counter.count(noted) + body_tokens <= budget:
+            break
+    if noted is not None:
+        steps.append(f"left out {len(dropped)} older message(s)")
+        messages = opening[:-1] + [noted] + body
+    return messages, steps
+
+class ContextWindow:
+    """ Keeps what a conversation sends within its model's context budget (see context_token_budget).
+        The conversation's own history is never changed; fit() returns the view to dispatch, which is
+        the snapshot itself until the history outgrows the budget.
+    """
+
+    def __init__(self):
+        self._counters = {}
+        self._last_fit = None
+
+    def get_counter(self, api_type, model):
+        key = (api_type, model)
+        if key not in self._counters:
+            self._counters[key] = TokenCounter(api_type, model)
+        return self._counters[key]
+
+    def fit(self, snapshot, settings):
+        """The history to send for snapshot: snapshot when it fits, otherwise a compacted MessageLog."""
+        counter = self.get_counter(settings.get("api_type"), settings.get("model"))
+        budget = context_token_budget(settings)
+        key = (snapshot.fingerprint, budget, counter.name)
+        if self._last_fit and self._last_fit[0] == key:
+            return self._last_fit[1]
+
+        messages, steps = compact_history(snapshot, budget, counter)
+        fitted = MessageLog(messages) if steps else snapshot
+        if steps and debug_mode:
+            print(f"DEBUG (Context): History of {len(snapshot)} message(s) over {budget} tokens: {', '.join(steps)}; "
+                  f"sending {len(fitted)} message(s), ~{counter.count_messages(fitted)} tokens.")
+        self._last_fit = (key, fitted)
+        return fitted
@@ -0,0 +1,1138 @@
+import asyncio
+import json
+import os
+import re
+import sys
+import time
+import traceback
+import uuid
+from context_window import END_OF_TURN, FAILED_RESULT, FORMAT_ERROR, TOOL_RESULT, ContextWindow
+from message_log import Message, MessageLog
+from providers import CancelToken, GeminiSessionManager, estimate_tokens, parse_tool_specs
+from response_cache import (DEFAULT_CACHE_SIZE, DEFAULT_SIMILARITY_THRESHOLD, answer_cache_key, answer_cache_scope,
+                            normalize_text)
+
+debug_mode = False
+
+# Modules with their own debug_mode flag, switched together by set_debug_mode()
+DEBUG_MODULES = ("core", "providers", "response_cache", "context_window", "chat_view", "server", "cli")
+
+def set_debug_mode(enabled):
+    """Turns debug output on or off in every loaded AnswerBot module."""
+    for name in DEBUG_MODULES:
+        module = sys.modules.get(name)
+        if module is not None:
+            module.debug_mode = enabled
+
+CONFIG_FILE = "answerbot_config.json"
+RESPONSE_CACHE_FILE = "answerbot_cache.json"
+SYSTEM_PROMPT_FILE = "SystemPrompt.txt"
+RESULT_PROMPT_FILE = "ResultPrompt.txt"
+USER_PROMPT_FILE = "UserPrompt.txt"
+BATCH_PROMPT_FILE = "BatchPrompt.txt"
+
+DEFAULT_SETTINGS = {
+    "api_type": "Ollama",  
+    "api_key": "",
+    "openai_endpoint_url": "", 
+    "ollama_endpoint_url": "http://localhost:11434", 
+    "model": "llama3", 
+    "rate_limit_seconds": 2,
+    "requests_per_minute": 0,
+    "tokens_per_minute": 0,
+    "prompt_caching": True,
+    "ollama_keep_alive": "30m",
+    "context_token_budget": 0,
+    "max_retries": 2,
+    "failover_backends": [],
+    "theme": "Mocha Dark", 
+    "always_on_top": False,
+    "openai_system_prompt_support": True, 
+    "stream_responses": True,
+    "defer_answer_acknowledgement": True,
+    "batched_tool_calls": True,
+    "structured_tool_calls": False,
+    "response_cache": True,
+    "response_cache_size": DEFAULT_CACHE_SIZE,
+    "semantic_cache": False,
+    "semantic_cache_threshold": DEFAULT_SIMILARITY_THRESHOLD,
+    "embedding_model": "nomic-embed-text",
+}
+
+# Answer tools that normally end a turn; their "Successful Tool Use" result can wait for the next user message
+TERMINAL_TOOLS = {"short_answer", "choice_answer", "math_answer", "code_answer", "long_answer"}
+
+# Tool name -> the parameter carrying its content; a call without it fails
+TOOL_ANSWER_PARAMS = {
+    "request_details": "msg",
+    "short_answer": "ans",
+    "long_answer": "ans",
+    "choice_answer": "ans",
+    "choice_explain": "ans",
+    "math_work": "work",
+    "math_answer": "ans",
+    "code_answer": "code",
+    "final_answer": "ans",
+}
+
+STREAM_PREVIEW_INTERVAL_S = 0.05
+
+# A model load (Ollama's load_duration) at least this long is reported in the status bar
+MODEL_LOAD_NOTICE_MS = 1000
+
+def load_settings():
+    """Loads settings from the JSON file."""
+    if not os.path.exists(CONFIG_FILE):
+        return DEFAULT_SETTINGS.copy()
+    try:
+        with open(CONFIG_FILE, 'r') as f:
+            settings = json.load(f)
+
+            for key, value in DEFAULT_SETTINGS.items():
+                settings.setdefault(key, value)
+            return settings
+    except (json.JSONDecodeError, IOError) as e:
+        print(f"Error loading settings: {e}. Using default settings.")
+        return DEFAULT_SETTINGS.copy()
+
+def save_settings(settings):
+    """Saves settings to the JSON file."""
+    try:
+        with open(CONFIG_FILE, 'w') as f:
+            json.dump(settings, f, indent=4)
+    except IOError as e:
+        print(f"Error saving settings: {e}")
+
+def load_prompt_file(filename):
+    """Loads content from a prompt file."""
+    try:
+        with open(filename, 'r', encoding='utf-8') as f:
+            return f.read()
+    except FileNotFoundError:
+        print(f"ERROR: Prompt file not found: {filename}")
+        return None
+    except IOError as e:
+        print(f"ERROR: Could not read prompt file {filename}: {e}")
+        return None
+
+def parse_partial_tool_call(partial_response):
+    """ Best-effort parse of a response that is still streaming in.
+        Returns (tool_name, partial_param_text) or (None, None) if nothing is displayable yet.
+    """
+    if not partial_response:
+        return None, None
+
+    text = re.sub(r'<thinking>.*?</thinking>', '', partial_response, flags=re.DOTALL | re.IGNORECASE).lstrip()
+    if not text or re.match(r'<thinking>', text, re.IGNORECASE) or '<thinking>'.startswith(text.lower()):
+        return None, None
+
+    if not text.startswith('<'):
+        if '<' in text:
+            return None, None
+        return "final_answer", text
+
+    tool_match = re.match(r'<(\w+)>', text)
+    if not tool_match:
+        return None, None
+    tool_name = tool_match.group(1).lower()
+
+    param_match = re.search(r'<(\w+)>', text[tool_match.end():])
+    if not param_match:
+        return tool_name, ""
+    param_start = tool_match.end() + param_match.end()
+    param_text = text[param_start:]
+
+    close_index = param_text.lower().find(f"</{param_match.group(1).lower()}>")
+    if close_index != -1:
+        param_text = param_text[:close_index]
+    else:
+        param_text = re.sub(r'<[^>]*$', '', param_text) 
+    return tool_name, param_text
+
+def _close_unclosed_params(inner_content, param_names):
+    """Inserts a missing </param> before the next tag (or the end) for every known parameter left open."""
+    repaired = inner_content
+    for open_match in reversed(list(re.finditer(r'<(\w+)>', inner_content))):
+        param_name = open_match.group(1)
+        if param_name not in param_names:
+            continue
+        if re.search(rf'</{param_name}>', inner_content[open_match.end():], re.IGNORECASE):
+            continue
+        next_tag = re.search(r'</?\w+>', repaired[open_match.end():])
+        insert_at = open_match.end() + next_tag.start() if next_tag else len(repaired.rstrip())
+        repaired = f"{repaired[:insert_at].rstrip()}</{param_name}>\n{repaired[insert_at:].lstrip()}"
+    return repaired
+
+def repair_tool_response(response_content, tool_names, param_names):
+    """ Tries to recover the intended tool call(s) from a response that failed the format check.
+        Only unambiguous near-misses are repaired: a markdown code fence around the call, odd tag
+        casing, prose before the first or after the last call and unclosed tool or parameter tags.
+        Prose between two calls is left alone: the reply may be weighing alternatives, so it is
+        sent back as a format error instead.
+        Returns (repaired_content, list_of_fixes); repaired_content is None when nothing applied.
+    """
+    if not response_content:
+        return None, []
+    fixes = []
+    text = response_content.strip()
+
+    fenced = re.fullmatch(r'```[\w-]*[ \t]*\n(.*?)\n?[ \t]*```', text, re.DOTALL)
+    if fenced:
+        text = fenced.group(1).strip()
+        fixes.append("code fence")
+
+    known_tags = set(tool_names) | set(param_names)
+    lowered = re.sub(
+        r'<(/?)(\w+)>',
+        lambda m: f"<{m.group(1)}{m.group(2).lower()}>" if m.group(2).lower() in known_tags else m.group(0),
+        text
+    )
+    if lowered != text:
+        text = lowered
+        fixes.append("tag case")
+
+    opened_tools = [name for name in re.findall(r'<(\w+)>', text) if name in tool_names]
+    if len(opened_tools) == 1 and f"</{opened_tools[0]}>" not in text:
+        tool_name = opened_tools[0]
+        text = re.sub(r'</?\w*$', '', text).rstrip() + f"\n</{tool_name}>"
+        fixes.append(f"unclosed <{tool_name}>")
+
+    tool_blocks = [
+        match for match in re.finditer(r'<(\w+)>(.*?)</\1>', text, re.DOTALL)
+        if match.group(1) in tool_names
+    ]
+    if not tool_blocks:
+        return None, []
+
+    rebuilt_blocks = []
+    for match in tool_blocks:
+        inner_content = _close_unclosed_params(match.group(2), param_names)
+        if inner_content != match.group(2):
+            fixes.append(f"unclosed parameter in <{match.group(1)}>")
+        rebuilt_blocks.append(f"<{match.group(1)}>{inner_content}</{match.group(1)}>")
+
+    gaps = [text[:tool_blocks[0].start()], text[tool_blocks[-1].end():]]
+    between = [text[previous.end():following.start()] for previous, following in zip(tool_blocks, tool_blocks[1:])]
+    if any('<' in gap or '>' in gap for gap in gaps + between) or any(gap.strip() for gap in between):
+        return None, []
+    if any(gap.strip() for gap in gaps):
+        fixes.append("text outside tool call")
+
+    if not fixes:
+        return None, []
+    return "\n".join(rebuilt_blocks), fixes
+
+DEFAULT_TOOL_NAMES = {
+    "request_details", "short_answer", "long_answer", "choice_answer", "choice_explain",
+    "math_work", "math_answer", "code_answer", "none_further", "final_answer"
+}
+DEFAULT_PARAM_NAMES = {"ans", "msg", "work", "code", "lang"}
+
+def strip_thinking(response_content):
+    """Removes <thinking>...</thinking> blocks from a response."""
+    return re.sub(r'<thinking>.*?</thinking>', '', response_content, flags=re.DOTALL | re.IGNORECASE).strip()
+
+def extract_tool_call(response_content):
+    """ Attempts to extract a single top-level tool call from the response.
+        Returns (tool_name, inner_content, error_message).
+        Error message is set if format is invalid or multiple/no tools found.
+    """
+    if not response_content:
+        return None, None, "AI response was empty."
+
+    response_content = response_content.strip()
+
+    match = re.fullmatch(r'<(\w+)>(.*?)</\1>', response_content, re.DOTALL | re.IGNORECASE)
+
+    if match:
+        tool_name = match.group(1)
+        inner_content = match.group(2)
+        if debug_mode: print(f"DEBUG: Extracted tool: <{tool_name}>")
+        return tool_name.lower(), inner_content, None 
+    else:
+
+        partial_match = re.search(r'<(\w+)>(.*?)</\1>', response_content, re.DOTALL | re.IGNORECASE)
+        if partial_match:
+            err = "Invalid format: Found tool call but also content outside the tags."
+            if debug_mode: print(f"DEBUG: {err} Content: {response_content[:100]}...")
+            return None, None, err
+        else:
+
+            if '<' in response_content or '>' in response_content:
+                err = "Invalid format: No valid tool call found, but contains tag-like characters."
+                if debug_mode: print(f"DEBUG: {err} Content: {response_content[:100]}...")
+                return None, None, err
+            else:
+
+                if debug_mode: print(f"DEBUG: No tool tag found, treating as implicit 'final_answer'.")
+                return "final_answer", response_content, None
+
+def extract_params(inner_content):
+    """ Extracts key-value pairs from the inner content of a tool call.
+        Returns a dictionary of parameters. Handles multi-line content.
+    """
+    params = {}
+
+    matches = re.findall(r'<(\w+)>(.*?)</\1>', inner_content, re.DOTALL | re.IGNORECASE)
+    for key, value in matches:
+        params[key.lower()] = value.strip() 
+    if debug_mode: print(f"DEBUG: Extracted params: {params}")
+    return params
+
+def tool_call_params(tool_name, inner_content):
+    """Parameters of one tool call; the implicit final_answer carries its whole text as 'ans'."""
+    return extract_params(inner_content) if tool_name != "final_answer" else {"ans": inner_content}
+
+def extract_tool_calls(response_content):
+    """ Extracts an ordered sequence of top-level tool calls (batched tool call mode).
+        Returns (list of (tool_name, inner_content), error_message).
+        A response holding a single call is parsed exactly like extract_tool_call.
+    """
+    tool_name, inner_content, format_error = extract_tool_call(response_content)
+    if not format_error:
+        return [(tool_name, inner_content)], None
+
+    response_content = response_content.strip()
+    tool_pattern = re.compile(r'<(\w+)>(.*?)</\1>', re.DOTALL | re.IGNORECASE)
+    tool_calls = []
+    position = 0
+    while position < len(response_content):
+        match = tool_pattern.match(response_content, position)
+        if not match:
+            return None, format_error
+        tool_calls.append((match.group(1).lower(), match.group(2)))
+        position = match.end()
+        while position < len(response_content) and response_content[position].isspace():
+            position += 1
+
+    if debug_mode: print(f"DEBUG: Extracted batch of {len(tool_calls)} tools: {[name for name, _ in tool_calls]}")
+    return tool_calls, None
+
+def parse_response_tools(response_content, batched):
+    """ Parses a cleaned response with the given tool call mode.
+        Returns (tool_calls, tool_name, inner_content, format_error); tool_name is only set for a single call.
+    """
+    if batched:
+        tool_calls, format_error = extract_tool_calls(response_content)
+        tool_name, inner_content = tool_calls[0] if tool_calls and len(tool_calls) == 1 else (None, None)
+        return tool_calls, tool_name, inner_content, format_error
+
+    tool_name, inner_content, format_error = extract_tool_call(response_content)
+    return None, tool_name, inner_content, format_error
+
+class PromptSet:
+    """ The prompt templates (SystemPrompt.txt, ResultPrompt.txt, UserPrompt.txt and the optional
+        BatchPrompt.txt) and the tool protocol declared in the system prompt.
+    """
+
+    def __init__(self):
+        self.system_prompt_template = load_prompt_file(SYSTEM_PROMPT_FILE)
+        self.result_prompt_template = load_prompt_file(RESULT_PROMPT_FILE)
+        self.user_prompt_template = load_prompt_file(USER_PROMPT_FILE)
+        self.batch_prompt_template = load_prompt_file(BATCH_PROMPT_FILE) if os.path.exists(BATCH_PROMPT_FILE) else None
+        self.tool_specs = parse_tool_specs(self.system_prompt_template)
+        self.tool_names = {spec["name"] for spec in self.tool_specs} or set(DEFAULT_TOOL_NAMES)
+        self.tool_param_names = {param[0] for spec in self.tool_specs for param in spec["params"]} or set(DEFAULT_PARAM_NAMES)
+        self._system_messages = {}
+
+    @property
+    def loaded(self):
+        """True when the three required prompt files were read."""
+        return all([self.system_prompt_template, self.result_prompt_template, self.user_prompt_template])
+
+    def get_system_prompt_template(self, batched):
+        """Returns the system prompt template, with the batched tool use section when that mode is on."""
+        template = self.system_prompt_template
+        if not template or not self.batch_prompt_template or not batched:
+            return template
+
+        batch_section = self.batch_prompt_template.strip()
+        if "<user_question>" in template:
+            before, after = template.split("<user_question>", 1)
+            return f"{before.rstrip()}\n\n{batch_section}\n\n<user_question>{after}"
+        return f"{template.rstrip()}\n\n{batch_section}"
+
+    def get_base_system_prompt(self, batched):
+        """The system prompt up to the question placeholder, for providers with a dedicated system role."""
+        return (self.get_system_prompt_template(batched) or "").split("{placeholderQuestion}")[0].strip()
+
+    def get_system_message(self, batched):
+        """The base system prompt as one shared Message, so every conversation references the same text."""
+        content = self.get_base_system_prompt(batched)
+        message = self._system_messages.get(batched)
+        if message is None or message.content != content:
+            message = self._system_messages[batched] = Message("system", content)
+        return message
+
+    def format_system_prompt(self, user_question, batched):
+        """Formats the system prompt, embedding the user's first question."""
+        system_prompt_template = self.get_system_prompt_template(batched)
+        if not system_prompt_template: return None
+
+        if "{placeholderQuestion}" not in system_prompt_template:
+             print("ERROR: '{placeholderQuestion}' not found in SystemPrompt.txt. Cannot embed first question.")
+
+             return system_prompt_template
+        return system_prompt_template.replace("{placeholderQuestion}", user_question)
+
+    def format_result_prompt(self, tool_name, success, error_message=None):
+        """Formats the result prompt string (to be added as a message)."""
+        if not self.result_prompt_template: return None
+        if success:
+             message = "Successful Tool Use"
+        elif error_message:
+
+             message = f"Tool Use Failed: {str(error_message)[:200]}" 
+        else:
+             message = "Tool Use Failed, Please Try Again" 
+
+        formatted = self.result_prompt_template.replace("Result:", message.strip())
+
+        formatted = formatted.replace("[tool]", f"[{tool_name}]")
+        return formatted.strip()
+
+    def format_user_prompt(self, user_response):
+         """Formats a subsequent user message using the user prompt template."""
+
+         if not self.user_prompt_template: return None
+         placeholder = "{userResponsePlaceholder}"
+         if self.user_prompt_template.count(placeholder) == 1:
+              return self.user_prompt_template.replace(placeholder, user_response)
+         else:
+              print(f"ERROR: Placeholder '{placeholder}' not found or found multiple times in UserPrompt.txt")
+              return user_response 
+
+    def build_first_messages(self, user_question, settings):
+        """ Opening messages for a new conversation: the shared system message plus the question for
+            providers with a system role (Gemini's becomes its system instruction), otherwise the system
+            prompt with the question embedded after it. Either way every conversation starts with the
+            same bytes, which is what provider prompt caches match on.
+        """
+        batched = settings.get("batched_tool_calls", True)
+        if settings.get("api_type") == "Gemini" or settings.get("openai_system_prompt_support", True):
+            return [self.get_system_message(batched), Message("user", user_question)]
+        system_prompt_content = self.format_system_prompt(user_question, batched)
+        if not system_prompt_content:
+            return None
+        return [Message("user", system_prompt_content)]
+
+class ConversationEngine:
+    """ One AnswerBot conversation without any GUI: owns the history, formats the prompts, runs the
+        tool loop and dispatches provider calls on the async engine. Views follow it through events
+        (see subscribe) rather than being called directly, so the same engine drives the Tk window,
+        batch runs and servers.
+
+        call_soon(fn, *args) decides where responses are handled; the Tk view passes after(0, ...)
+        so every event reaches it on the main thread. By default they are handled inline.
+    """
+
+    def __init__(self, settings, prompts, dispatcher, engine, response_cache=None, call_soon=None, max_requests_per_turn=None):
+        self.settings = settings
+        self.prompts = prompts
+        self.dispatcher = dispatcher
+        self.engine = engine
+        self.response_cache = response_cache
+        self.call_soon = call_soon or (lambda fn, *args: fn(*args))
+        self.max_requests_per_turn = max_requests_per_turn
+        self.gemini_sessions = GeminiSessionManager()
+        self.context_window = ContextWindow()
+        # Keeps this conversation's requests on one Ollama endpoint when several are configured
+        self.affinity_key = uuid.uuid4().hex
+        self.listeners = []
+        self.usage = {}
+        self.usage_at_request = {}
+        self.api_calls = 0
+        self.turn_requests = 0
+        self.last_api_type = None
+        self.last_model = None
+        self.api_request_generation = 0
+        self.current_api_task = None
+        self.current_cancel_token = None
+        self.expecting_response = True
+        self.bypass_cache_once = False
+        self.format_repair_count = 0
+        self.format_retry_count = 0
+        self._clear_conversation()
+
+    def _clear_conversation(self):
+        self.conversation_history = MessageLog()
+        self.conversation_active = False
+        self.waiting_for_user_detail = False
+        self.last_tool_invoked = None
+        self.deferred_results = []
+        self.cache_recording = None
+
+    def subscribe(self, listener):
+        """ Registers listener(event, **data) and returns a function that unregisters it. Events:
+            thinking(active), status(message, duration_ms), rate_limited(delay_s), stream(generation, text),
+            stream_end(), tool(tool_name, params), error(message), cache_hit(question, similarity)
+            and turn_ended(reason) with reason answered, complete, needs_details, cached or error.
+        """
+        self.listeners.append(listener)
+        return lambda: self.listeners.remove(listener) if listener in self.listeners else None
+
+    def _emit(self, event, **data):
+        for listener in list(self.listeners):
+            listener(event, **data)
+
+    @property
+    def batched(self):
+        return self.settings.get("batched_tool_calls", True)
+
+    def reset(self):
+        """Cancels the request in flight and clears the conversation (New Chat)."""
+        self.expecting_response = False
+        self._cancel_current_request()
+        self.gemini_sessions.reset()
+        self._clear_conversation()
+        if debug_mode: print("DEBUG: Conversation reset. History and state cleared.")
+
+    def close(self):
+        """Stops expecting responses and cancels the request in flight."""
+        self.expecting_response = False
+        self._cancel_current_request()
+
+    def send(self, user_input):
+        """ Adds a user message and starts the tool loop for it: the first message of a chat (which may be
+            answered from the cache), an answer to request_details, or a follow-up message.
+            Returns False when the message could not be sent.
+        """
+        is_first_message = not self.conversation_history
+        self.turn_requests = 0
+
+        if self.waiting_for_user_detail:
+
+             if debug_mode: print(f"DEBUG: Handling user response after request_details.")
+
+             self.conversation_history.append("user", self._prepend_deferred_results(user_input))
+             self.waiting_for_user_detail = False 
+             self.cache_recording = None
+
+        elif is_first_message:
+
+            if debug_mode: print("DEBUG: Handling first message of a new chat.")
+
+            if not self.prompts.format_system_prompt(user_input, self.batched):
+                self._emit("status", message="❌ Error formatting system prompt", duration_ms=5000)
+                return False
+            self.conversation_history.extend(self.prompts.build_first_messages(user_input, self.settings))
+            if debug_mode: print(f"DEBUG: Opened chat with {len(self.conversation_history)} message(s) (system role: {self.conversation_history[0].role == 'system'}).")
+
+            if self.response_cache is not None and self.settings.get("response_cache", True):
+                 bypass_cache = self.bypass_cache_once
+                 self.bypass_cache_once = False
+                 cache_key = self.get_answer_cache_key(user_input)
+                 cached_entry = None if bypass_cache else self.response_cache.get(cache_key)
+                 if cached_entry:
+                      self._replay_cached_answer(user_input, cached_entry)
+                      return True
+                 self.cache_recording = {"key": cache_key, "start": len(self.conversation_history), "question": user_input}
+                 if self.settings.get("semantic_cache", False) and not bypass_cache:
+                      self.expecting_response = True
+                      self._lookup_similar_answer(user_input)
+                      return True
+
+        else:
+
+             if debug_mode: print("DEBUG: Handling subsequent user message.")
+
+             self.conversation_history.append("user", self._prepend_deferred_results(user_input))
+             self.cache_recording = None
+
+        self.expecting_response = True 
+        self._schedule_api_call()
+        return True
+
+    def get_answer_cache_key(self, question):
+        return answer_cache_key(self.settings.get("api_type"), self.settings.get("model"), self.get_system_prompt_template(), question)
+
+    def get_answer_cache_scope(self):
+        return answer_cache_scope(self.settings.get("api_type"), self.settings.get("model"), self.get_system_prompt_template())
+
+    def get_system_prompt_template(self):
+        return self.prompts.get_system_prompt_template(self.batched)
+
+    def get_rate_limiter(self, api_type=None):
+        """ Returns the rate limiter for an API type (default: the current one). The configured budgets
+            apply to the current API type; failover providers are only limited by what they report.
+        """
+        return self.dispatcher.get_rate_limiter(self.settings, api_type)
+
+    def _lookup_similar_answer(self, question):
+        """ Embeds the question on the engine and serves a cached answer to a near-duplicate question,
+            falling through to the API call when nothing is similar enough or embedding fails.
+        """
+        self._emit("thinking", active=True)
+        self._emit("status", message="🔎 Looking for a similar answered question...", duration_ms=None)
+        self._cancel_current_request()
+        cancel_token = self.current_cancel_token = CancelToken()
+        embedding_request = self.dispatcher.ollama_embedding(
+            normalize_text(question), self.settings.get("embedding_model"), self.settings.get("ollama_endpoint_url")
+        )
+        future = self.engine.submit(embedding_request, cancel_token)
+        future.add_done_callback(lambda f: self.call_soon(self._finish_similar_answer_lookup, f, cancel_token, question))
+
+    def _finish_similar_answer_lookup(self, future, cancel_token, question):
+        if future.cancelled() or cancel_token is not self.current_cancel_token or not self.expecting_response:
+            return
+        self.current_cancel_token = None
+
+        embedding = None
+        try:
+            embedding = future.result()
+        except Exception as e:
+            if debug_mode: print(f"DEBUG: Question embedding failed, skipping similar-answer lookup: {e}")
+
+        if embedding and self.cache_recording:
+            embedding_model = self.settings.get("embedding_model")
+            scope = self.get_answer_cache_scope()
+            entry, similarity = self.response_cache.find_similar(
+                scope, embedding_model, embedding, self.settings.get("semantic_cache_threshold", DEFAULT_SIMILARITY_THRESHOLD)
+            )
+            if debug_mode: print(f"DEBUG: Closest cached question similarity: {similarity:.3f}")
+            if entry:
+                self.cache_recording = None
+                self._emit("thinking", active=False)
+                self._replay_cached_answer(question, entry, similarity)
+                return
+            self.cache_recording.update({"scope": scope, "embedding_model": embedding_model, "embedding": embedding})
+
+        self._emit("thinking", active=False)
+        self._schedule_api_call()
+
+    def _finish_cache_recording(self):
+        """Stores the tool sequence that just answered the chat's first question in the response cache."""
+        recording = self.cache_recording
+        self.cache_recording = None
+        if not recording or self.response_cache is None or not self.settings.get("response_cache", True):
+            return
+        entry = {
+            "question": recording["question"],
+            "messages": [message.to_dict() for message in self.conversation_history[recording["start"]:]],
+            "deferred_results": list(self.deferred_results),
+            "created": time.time()
+        }
+        if recording.get("embedding"):
+            entry.update({key: recording[key] for key in ("scope", "embedding_model", "embedding")})
+        self.response_cache.resize(self.settings.get("response_cache_size", DEFAULT_CACHE_SIZE))
+        self.response_cache.put(recording["key"], entry)
+        if debug_mode: print(f"DEBUG: Cached answer sequence of {len(entry['messages'])} message(s).")
+
+    def _replay_cached_answer(self, question, entry, similarity=None):
+        """ Emits a cached tool sequence without calling the API and restores the conversation
+            state it left behind, so follow-up messages continue as if the answer had been live.
+        """
+        if debug_mode: print(f"DEBUG: Serving answer from cache ({len(entry['messages'])} message(s)).")
+        for message in entry["messages"]:
+            self.conversation_history.append(message["role"], message["content"], message.get("kind"))
+            if message.get("role") != "assistant" or not message.get("content"):
+                continue
+
+            tool_calls, tool_name, inner_content, format_error = parse_response_tools(message["content"], self.batched)
+            if format_error:
+                continue
+            for call_name, call_content in (tool_calls or [(tool_name, inner_content)]):
+                try:
+                    self._run_tool_handler(call_name, call_content)
+                except Exception as e:
+                    print(f"ERROR: Exception while replaying cached tool '{call_name}': {e}")
+                    if debug_mode: traceback.print_exc()
+
+        self.deferred_results = list(entry.get("deferred_results", []))
+        self.conversation_active = False
+        self.waiting_for_user_detail = False
+        self.expecting_response = False
+        self._emit("cache_hit", question=question, similarity=similarity)
+        self._emit("turn_ended", reason="cached")
+
+    def _run_tool_handler(self, tool_name, inner_content):
+        """Applies a single tool call to the conversation state, emits it for rendering and returns whether it succeeded."""
+        self.last_tool_invoked = tool_name 
+        if tool_name == "request_details":
+            self.cache_recording = None
+        params = tool_call_params(tool_name, inner_content)
+
+        if tool_name != "none_further":
+            if tool_name not in TOOL_ANSWER_PARAMS:
+                self._emit("error", message=f"Error: Received unknown tool '{tool_name}'.")
+                return False
+            required = TOOL_ANSWER_PARAMS[tool_name]
+            value = params.get(required)
+            if value is None or (tool_name == "request_details" and not value):
+                if tool_name == "final_answer":
+                    self._emit("error", message="Error: 'final_answer' (implicit) called without content.")
+                else:
+                    self._emit("error", message=f"Error: '{tool_name}' tool called without '{required}' parameter.")
+                return False
+
+        if tool_name == "request_details":
+            self.waiting_for_user_detail = True
+            if debug_mode: print("DEBUG: Waiting for user detail.")
+        elif tool_name in ["final_answer", "none_further"]:
+            self.conversation_active = False
+            self.waiting_for_user_detail = False
+            if debug_mode: print(f"DEBUG: Received {tool_name}. Conversation marked inactive.")
+
+        self._emit("tool", tool_name=tool_name, params=params)
+        if tool_name in ["request_details", "final_answer", "none_further"]:
+            self._emit("thinking", active=False)
+        return True 
+
+    def _handle_tool_response(self, tool_name, inner_content):
+        """Main dispatcher for handling validated tool responses."""
+        try:
+            success = self._run_tool_handler(tool_name, inner_content)
+            if tool_name == "none_further":
+                self._finish_cache_recording()
+                self._emit("turn_ended", reason="complete")
+                return
+            if tool_name == "request_details":
+                if success:
+                    self._emit("turn_ended", reason="needs_details")
+                    return
+                self._send_result_to_ai(tool_name, success)
+                return
+
+            self._emit("thinking", active=False)
+            if success and tool_name in TERMINAL_TOOLS and self.settings.get("defer_answer_acknowledgement", True):
+                self._defer_result_to_next_turn(tool_name)
+                self._finish_cache_recording()
+            else:
+                self._send_result_to_ai(tool_name, success)
+
+        except Exception as e:
+            print(f"ERROR: Exception while handling tool '{tool_name}': {e}")
+            if debug_mode: traceback.print_exc()
+            self._emit("error", message=f"Internal Error processing tool '{tool_name}'.")
+            self._emit("thinking", active=False)
+
+            self._send_result_to_ai(tool_name, False, error_message="Internal processing error")
+
+    def _handle_tool_batch(self, tool_calls):
+        """ Dispatches an ordered batch of tool calls in one pass and answers them with
+            a single combined result message (or none at all when the batch ends the task).
+        """
+        result_payloads = []
+        all_succeeded = True
+        for tool_name, inner_content in tool_calls:
+            error_message = None
+            try:
+                success = self._run_tool_handler(tool_name, inner_content)
+            except Exception as e:
+                print(f"ERROR: Exception while handling tool '{tool_name}': {e}")
+                if debug_mode: traceback.print_exc()
+                self._emit("error", message=f"Internal Error processing tool '{tool_name}'.")
+                success = False
+                error_message = "Internal processing error"
+
+            if tool_name == "none_further" and all_succeeded:
+                if debug_mode: print("DEBUG: Batch ended with none_further.")
+                self._finish_cache_recording()
+                self._emit("turn_ended", reason="complete")
+                return 
+            if tool_name == "request_details" and success:
+                self.deferred_results.extend(result_payloads)
+                self._emit("turn_ended", reason="needs_details")
+                return 
+
+            result_payloads.append(self.prompts.format_result_prompt(tool_name, success, error_message))
+            all_succeeded = all_succeeded and success
+
+        self._emit("thinking", active=False)
+        if all_succeeded and tool_calls[-1][0] in TERMINAL_TOOLS and self.settings.get("defer_answer_acknowledgement", True):
+            self._defer_results_to_next_turn(result_payloads)
+            self._finish_cache_recording()
+        else:
+            self._send_result_payload_to_ai("\n\n".join(payload for payload in result_payloads if payload),
+                                            TOOL_RESULT if all_succeeded else FAILED_RESULT)
+
+    def _send_result_to_ai(self, tool_name, success, error_message=None):
+         """ Formats a Result Prompt, adds it to history, and initiates the next API call """
+         self._send_result_payload_to_ai(self.prompts.format_result_prompt(tool_name, success, error_message),
+                                         TOOL_RESULT if success else FAILED_RESULT)
+
+    def _send_result_payload_to_ai(self, result_payload_string, kind=None):
+         """ Adds already formatted result message(s) to history and initiates the next API call """
+         if not result_payload_string:
+              print("ERROR: Failed to format result prompt.")
+              self._emit("status", message="❌ Error sending result", duration_ms=5000)
+              self.conversation_active = False 
+              self._emit("thinking", active=False)
+              self._emit("turn_ended", reason="error")
+              return
+
+         self.conversation_history.append("user", result_payload_string, kind)
+         if debug_mode:
+              print(f"DEBUG: Appended result message to history (as user): {result_payload_string[:100]}...")
+
+         self.expecting_response = True
+         self._schedule_api_call()
+
+    def _defer_result_to_next_turn(self, tool_name):
+         """ Records the result of a terminal answer tool locally instead of making an API call
+             just to have it acknowledged. It is sent along with the next user message.
+         """
+         result_payload_string = self.prompts.format_result_prompt(tool_name, True)
+         if not result_payload_string:
+              self._send_result_to_ai(tool_name, True)
+              return
+         self._defer_results_to_next_turn([result_payload_string])
+
+    def _defer_results_to_next_turn(self, result_payloads):
+         """Holds formatted result messages until the next user message and ends the turn."""
+         self.deferred_results.extend(payload for payload in result_payloads if payload)
+         self.conversation_active = False
+         if debug_mode: print(f"DEBUG: Deferred {len(result_payloads)} tool result(s) to the next user turn.")
+         self._emit("turn_ended", reason="answered")
+
+    def _prepend_deferred_results(self, user_input):
+         """Combines any deferred tool results with the next user message."""
+         if not self.deferred_results:
+              return user_input
+
+         formatted_user_input = self.prompts.format_user_prompt(user_input) or user_input
+         combined = "\n\n".join(self.deferred_results + [formatted_user_input])
+         self.deferred_results = []
+         if debug_mode: print("DEBUG: Sending deferred tool results with the new user message.")
+         return combined
+
+    def _schedule_api_call(self):
+        """Starts the API call, waiting first if the rate limiter asks for a delay."""
+        if self.max_requests_per_turn and self.turn_requests >= self.max_requests_per_turn:
+            self._emit("error", message=f"Error: Stopped after {self.turn_requests} API calls without an answer.")
+            self._emit("thinking", active=False)
+            self._emit("turn_ended", reason="error")
+            return
+
+        delay_s = self.get_rate_limiter().delay_for(estimate_tokens(self.get_dispatch_history()))
+        if delay_s > 0:
+            if debug_mode: print(f"DEBUG: Rate limiting: delaying API call by {delay_s:.1f}s")
+            self._emit("rate_limited", delay_s=delay_s)
+        self.initiate_api_call(delay_s)
+
+    def initiate_api_call(self, delay_s=0):
+        """Starts the API call for conversation_history as a task on the async engine."""
+        if not self.conversation_history:
+             print("ERROR: Initiate API call requested but conversation_history is empty!")
+             self._emit("thinking", active=False)
+             self._emit("status", message="❌ Internal Error: No history", duration_ms=5000)
+             return
+
+        self.expecting_response = True
+        self.api_request_generation += 1
+        self.turn_requests += 1
+        self._emit("stream_end")
+        if delay_s <= 0:
+            self._emit("thinking", active=True)
+
+        history_copy = self.get_dispatch_history()
+        self.usage_at_request = dict(self.usage)
+
+        if debug_mode:
+             print("\n--- INITIATING API CALL ---")
+             print(f"History Length: {len(history_copy)}")
+
+             for msg in history_copy[-5:]:
+                 print(f" - Role: {msg.get('role')}, Content: {str(msg.get('content'))[:100]}{'...' if len(str(msg.get('content')))>100 else ''}")
+             print("---------------------------\n")
+
+        if self.current_api_task and not self.current_api_task.done():
+             if debug_mode: print("DEBUG: Previous API request still running, cancelling it (new request supersedes).")
+        self._cancel_current_request()
+
+        self.current_cancel_token = CancelToken()
+        self.current_api_task = self.engine.submit(
+            self._get_ai_response_async(history_copy, self.api_request_generation, delay_s), self.current_cancel_token
+        )
+
+    def get_dispatch_history(self):
+        """ The history to send: a snapshot of conversation_history, compacted to the context budget
+            once it outgrows it (the conversation itself keeps every message).
+        """
+        return self.context_window.fit(self.conversation_history.snapshot(), self.settings)
+
+    def _cancel_current_request(self):
+         """Cancels the in-flight request's task (closing its stream/connection) so the backend is freed immediately."""
+         if self.current_cancel_token:
+              self.current_cancel_token.cancel()
+              self.current_cancel_token = None
+
+    def _is_current(self, generation):
+        return self.expecting_response and generation == self.api_request_generation
+
+    def _emit_if_current(self, generation, event, data):
+        if self._is_current(generation):
+            self._emit(event, **data)
+
+    async def _get_ai_response_async(self, current_history, generation, delay_s=0):
+        """ Engine task that waits out any rate limit delay and calls the appropriate API with the
+            conversation history. Cancelling the task (New Chat, a superseding request) aborts the call in flight.
+        """
+        response = None
+        raw_response_for_debug = None
+        error_message = None
+        api_type = self.settings.get("api_type")
+        model = self.settings.get("model")
+
+        tool_specs = None
+        allow_multiple = self.batched
+        if self.settings.get("structured_tool_calls", False) and self.prompts.tool_specs:
+            tool_specs = self.prompts.tool_specs
+
+        streamed_parts = []
+        reset_stream = streamed_parts.clear
+        last_preview_time = [0.0]
+
+        def preview_stream(text):
+            streamed_parts.append(text)
+            now = time.time()
+            if now - last_preview_time[0] < STREAM_PREVIEW_INTERVAL_S: return
+            last_preview_time[0] = now
+            if self._is_current(generation):
+                self.call_soon(self._emit_if_current, generation, "stream", {"generation": generation, "text": "".join(streamed_parts)})
+
+        on_delta = preview_stream if self.settings.get("stream_responses", True) and not tool_specs else None
+
+        def on_status(message):
+            self.call_soon(self._emit_if_current, generation, "status", {"message": message, "duration_ms": None})
+
+        try:
+            if delay_s > 0:
+                await asyncio.sleep(delay_s)
+                self.call_soon(self._emit_if_current, generation, "thinking", {"active": True})
+
+            start_time = time.time()
+            if debug_mode: print(f"DEBUG [Engine]: Calling API '{api_type}' with model '{model}'...")
+
+            response, raw_response_for_debug, api_type, model = await self.dispatcher.request(
+                self.settings, current_history, on_delta, reset_stream, tool_specs, allow_multiple,
+                gemini_sessions=self.gemini_sessions, on_status=on_status, usage=self.usage, affinity=self.affinity_key
+            )
+            end_time = time.time()
+
+            if not self.expecting_response:
+                 if debug_mode: print(f"DEBUG [Engine]: API call ({api_type}) completed ({end_time - start_time:.2f}s), but response no longer expected. Discarding.")
+
+                 if generation == self.api_request_generation:
+                      self.call_soon(lambda: self._emit("thinking", active=False))
+                 return 
+
+            if debug_mode: print(f"DEBUG [Engine]: API call ({api_type}) took {end_time - start_time:.2f} seconds.")
+
+            if debug_mode and (response is not None or raw_response_for_debug is not None):
+                 print("\n--- RAW AI RESPONSE ---")
+                 print(f"API Type: {api_type}")
+                 print(f"Response Content Variable Type: {type(response)}")
+                 print(f"Response Content Value:\n{response}")
+                 if raw_response_for_debug:
+                      print("\n--- RAW API OBJECT/DATA ---")
+                      try:
+
+                           if hasattr(raw_response_for_debug, 'model_dump_json'): print(raw_response_for_debug.model_dump_json(indent=2))
+                           elif hasattr(raw_response_for_debug, 'to_dict'): print(json.dumps(raw_response_for_debug.to_dict(), indent=2)) 
+                           elif hasattr(raw_response_for_debug, 'model_dump'): print(json.dumps(raw_response_for_debug.model_dump(), indent=2))
+                           elif isinstance(raw_response_for_debug, dict) or isinstance(raw_response_for_debug, list): print(json.dumps(raw_response_for_debug, indent=2))
+                           else: print(raw_response_for_debug)
+                      except Exception as dump_err:
+                          print(f"(Error during debug dump: {dump_err})")
+                          print(raw_response_for_debug) 
+                 print("-----------------------\n")
+
+        except asyncio.CancelledError:
+             if debug_mode: print(f"DEBUG [Engine]: API call ({api_type}) was cancelled.")
+             raise
+        except ImportError as e:
+             error_message = f"Missing library: {e}. Please install it."
+             if debug_mode: print(f"\n--- API TASK IMPORT ERROR ---\n{error_message}\n-----------------------------\n")
+        except Exception as e:
+            error_message = f"API Error ({api_type}): {e}"
+            if debug_mode:
+                print(f"\n--- API TASK ERROR ({api_type}) ---")
+                print(f"Error Message: {error_message}")
+                traceback.print_exc()
+                print("------------------------\n")
+
+        is_current = generation == self.api_request_generation
+        if self.expecting_response and is_current:
+             self.call_soon(self._handle_response, generation, response, error_message, api_type, model)
+        elif self.expecting_response:
+             if debug_mode: print("DEBUG [Engine]: API response received, but a newer request is active. Discarding.")
+        else:
+             if debug_mode: print("DEBUG [Engine]: API response received, but not expecting one. Discarding.")
+
+             if is_current:
+                  self.call_soon(lambda: self._emit("thinking", active=False))
+
+    def _handle_response(self, generation, response_content, error_message, api_type=None, model=None):
+        """Records the AI response or error and runs the tool loop on it (runs on the owner's thread)."""
+        if generation != self.api_request_generation:
+             return
+        self.current_cancel_token = None
+        self.api_calls += 1
+        self.last_api_type, self.last_model = api_type, model
+        self._report_model_load(model)
+        try:
+            self._render_response(response_content, error_message)
+        finally:
+            self._emit("stream_end")
+
+    def _report_model_load(self, model):
+        """Shows how long the last request spent loading the model versus generating, when the load was noticeable."""
+        load_ms = self.usage.get("load_ms", 0) - self.usage_at_request.get("load_ms", 0)
+        if load_ms < MODEL_LOAD_NOTICE_MS:
+            return
+        eval_ms = self.usage.get("eval_ms", 0) - self.usage_at_request.get("eval_ms", 0)
+        self._emit("status", message=f"🐢 Loading {model} took {load_ms / 1000:.1f}s (answer: {eval_ms / 1000:.1f}s)", duration_ms=5000)
+
+    def _render_response(self, response_content, error_message):
+        """Records the AI response in history and dispatches it to the matching tool handler."""
+        if not self.expecting_response:
+             if debug_mode: print("DEBUG: Ignoring response (not expecting).")
+             self._emit("thinking", active=False)
+             return
+
+        if response_content:
+
+             cleaned_response_content = strip_thinking(response_content)
+             if debug_mode and cleaned_response_content != response_content:
+                  print(f"DEBUG: Stripped <thinking> tags. Original length: {len(response_content)}, Cleaned length: {len(cleaned_response_content)}")
+             response_content = cleaned_response_content 
+
+        if error_message:
+
+            self._emit("thinking", active=False)
+            self._emit("error", message=error_message)
+            self._emit("status", message="❌ API Error", duration_ms=5000)
+            self._emit("turn_ended", reason="error")
+
+        elif response_content:
+
+            tool_calls, tool_name, inner_content, format_error = parse_response_tools(response_content, self.batched)
+
+            if format_error:
+                 repaired_content, fixes = repair_tool_response(response_content, self.prompts.tool_names, self.prompts.tool_param_names)
+                 if repaired_content:
+                      repaired = parse_response_tools(repaired_content, self.batched)
+                      if not repaired[3]:
+                           tool_calls, tool_name, inner_content, format_error = repaired
+                           response_content = repaired_content
+                           self.format_repair_count += 1
+                           self._emit("status", message=f"🔧 Repaired AI response format ({self.format_repair_count} retries saved)", duration_ms=3000)
+                           if debug_mode: print(f"DEBUG: Repaired response locally ({', '.join(fixes)}). Round-trips saved: {self.format_repair_count}")
+
+            if format_error:
+                 kind = FORMAT_ERROR
+            elif tool_name == "none_further":
+                 kind = END_OF_TURN
+            else:
+                 kind = None
+            self.conversation_history.append("assistant", response_content, kind)
+            if debug_mode: print(f"DEBUG: Appended AI response to history: {response_content[:100]}...")
+
+            if format_error:
+
+                 if debug_mode:
+                     print(f"DEBUG: AI Response Format Error (after stripping <thinking>): {format_error}")
+                     print(f"DEBUG: Cleaned response evaluated: {response_content[:200]}...")
+
+                 self._emit("error", message=f"Format Error: AI response was invalid. ({format_error})")
+                 self._emit("status", message="⏳ AI Format Error, Retrying...", duration_ms=None)
+
+                 self.format_retry_count += 1
+                 if debug_mode: print(f"DEBUG: Format errors retried remotely: {self.format_retry_count}, repaired locally: {self.format_repair_count}")
+                 failed_tool_name = self.last_tool_invoked or "format_error"
+                 self._send_result_to_ai(failed_tool_name, False, error_message=format_error)
+
+            elif tool_name:
+
+                 if debug_mode: print(f"DEBUG: Handling valid tool/response: {tool_name}")
+                 self._handle_tool_response(tool_name, inner_content)
+            elif tool_calls:
+
+                 self._handle_tool_batch(tool_calls)
+            else:
+
+                 print("ERROR: Unexpected condition in _render_response after tool extraction.")
+                 self._emit("thinking", active=False)
+                 self._emit("error", message="Internal Error: Unexpected response state.")
+                 self._emit("turn_ended", reason="error")
+
+        else:
+
+             err_msg = "Error: Received an empty response from the API (after removing <thinking> tags)."
+             self._emit("thinking", active=False)
+             self._emit("error", message=err_msg)
+             self._emit("status", message="⚠️ Empty Response", duration_ms=5000)
+             if debug_mode: print(f"DEBUG: {err_msg} Original response might have only contained <thinking> tags.")
+
+             self.conversation_history.append("assistant", "")
+             self._emit("turn_ended", reason="error")
+
+class TurnRecord:
+    """ Collects the outcome of one conversation turn from ConversationEngine events: every tool call,
+        the answer and how the turn ended, plus the latency, API calls and token usage it took.
+    """
+
+    def __init__(self, conversation):
+        self.conversation = conversation
+        self.started = time.monotonic()
+        self.usage_before = dict(conversation.usage)
+        self.api_calls_before = conversation.api_calls
+        self.status = None
+        self.tool = None
+        self.answer = None
+        self.tools = []
+        self.details_requested = None
+        self.error = None
+        self._last_error = None
+
+    @property
+    def ended(self):
+        return self.status is not None
+
+    def add_event(self, event, **data):
+        """Records one event and returns True if it ended the turn."""
+        if event == "tool":
+            tool_name, params = data["tool_name"], data["params"]
+            self.tools.append({"tool": tool_name, "params": params})
+            if tool_name in TERMINAL_TOOLS or tool_name == "final_answer":
+                self.tool, self.answer = tool_name, params.get(TOOL_ANSWER_PARAMS[tool_name])
+            elif tool_name == "request_details":
+                self.details_requested = params.get("msg")
+        elif event == "error":
+            self._last_error = data["message"]
+        elif event == "turn_ended":
+            reason = data["reason"]
+            if reason in ["needs_details", "error"]:
+                self.status = reason
+            else:
+                self.status = "answered" if self.answer is not None else "no_answer"
+            if reason == "error":
+                self.error = self._last_error
+            return True
+        return False
+
+    def fail(self, error):
+        self.status = "error"
+        self.error = error
+
+    def to_dict(self):
+        """ JSON-ready summary: status (answered, no_answer, needs_details or error), the answering tool
+            and its answer, every tool call made, latency and the API calls and token usage of this turn.
+        """
+        usage = {key: value - self.usage_before.get(key, 0) for key, value in self.conversation.usage.items()}
+        record = {
+            "status": self.status or "error",
+            "tool": self.tool,
+            "answer": self.answer,
+            "tools": self.tools,
+            "error": self.error,
+            "api_type": self.conversation.last_api_type,
+            "model": self.conversation.last_model,
+            "api_calls": self.conversation.api_calls - self.api_calls_before,
+            "latency_s": round(time.monotonic() - self.started, 3),
+            "usage": usage
+        }
+        if self.details_requested is not None:
+            record["details_requested"] = self.details_requested
+        return record
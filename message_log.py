@@ -0,0 +1,129 @@
+from itertools import islice
+from response_cache import fingerprint
+
+class Message:
+    """ One immutable chat message. Provider adapters cache their translation of it (see translated),
+        so a message is converted once however many requests resend it. Reads like the
+        {"role", "content"} dicts it replaces (message.get("role"), message["content"]).
+        kind optionally tags protocol messages (tool results, format errors) for context compaction.
+    """
+    __slots__ = ("role", "content", "kind", "tokens", "_translations")
+
+    def __init__(self, role, content, kind=None):
+        object.__setattr__(self, "role", role)
+        object.__setattr__(self, "content", content)
+        object.__setattr__(self, "kind", kind)
+        object.__setattr__(self, "tokens", len(str(content or "")) // 4 + 4)
+        object.__setattr__(self, "_translations", {})
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Message is immutable")
+
+    def __getitem__(self, key):
+        if key in ("role", "content"):
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in ("role", "content") else default
+
+    def __repr__(self):
+        return f"Message({self.role!r}, {str(self.content)[:40]!r})"
+
+    @classmethod
+    def from_dict(cls, message):
+        if isinstance(message, Message):
+            return message
+        return cls(message.get("role"), message.get("content"), message.get("kind"))
+
+    def to_dict(self):
+        if self.kind:
+            return {"role": self.role, "content": self.content, "kind": self.kind}
+        return {"role": self.role, "content": self.content}
+
+    def translated(self, provider, translate):
+        """Returns translate(self), computed once per provider and reused afterwards."""
+        translations = self._translations
+        if provider not in translations:
+            translations[provider] = translate(self)
+        return translations[provider]
+
+    @property
+    def digest(self):
+        return self.translated("digest", lambda message: fingerprint(message.role, message.content))
+
+def translate_message(message, provider, translate):
+    """translate(message), cached on the message when it is a Message (plain dicts are translated every time)."""
+    if isinstance(message, Message):
+        return message.translated(provider, translate)
+    return translate(message)
+
+class HistorySnapshot:
+    """ The first length messages of a MessageLog, taken in O(1). Messages are immutable and the log
+        only ever appends, so the snapshot stays valid while the conversation continues.
+    """
+    __slots__ = ("_messages", "_chain", "_token_totals", "_length")
+
+    def __init__(self, messages, chain, token_totals, length):
+        self._messages = messages
+        self._chain = chain
+        self._token_totals = token_totals
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return islice(self._messages, self._length)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(islice(self._messages, self._length))[index]
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("history index out of range")
+        return self._messages[index]
+
+    @property
+    def fingerprint(self):
+        """Digest of the whole snapshot, chained message by message as the log grew."""
+        return self._chain[self._length - 1] if self._length else fingerprint()
+
+    @property
+    def estimated_tokens(self):
+        return self._token_totals[self._length - 1] if self._length else 0
+
+    def to_dicts(self):
+        return [message.to_dict() for message in self]
+
+class MessageLog(HistorySnapshot):
+    """ Append-only conversation history of immutable Messages. snapshot() hands workers the current
+        history in O(1) instead of a deep copy; a repeated message such as the system prompt is the
+        same Message object wherever it appears. clear() starts new storage so snapshots stay intact.
+    """
+    __slots__ = ()
+
+    def __init__(self, messages=()):
+        super().__init__([], [], [], 0)
+        self.extend(messages)
+
+    def append(self, role, content, kind=None):
+        self.append_message(Message(role, content, kind))
+
+    def append_message(self, message):
+        previous = self._chain[-1] if self._chain else ""
+        self._messages.append(message)
+        self._chain.append(fingerprint(previous, message.digest))
+        self._token_totals.append((self._token_totals[-1] if self._token_totals else 0) + message.tokens)
+        self._length += 1
+
+    def extend(self, messages):
+        for message in messages:
+            self.append_message(Message.from_dict(message))
+
+    def clear(self):
+        self._messages, self._chain, self._token_totals, self._length = [], [], [], 0
+
+    def snapshot(self):
+        return HistorySnapshot(self._messages, self._chain, self._token_totals, self._length)
@@ -0,0 +1,1446 @@
+import asyncio
+import collections
+import concurrent.futures
+import datetime
+import json
+import random
+import re
+import threading
+import time
+from message_log import HistorySnapshot, Message, translate_message
+from response_cache import fingerprint
+
+debug_mode = False
+
+try:
+    import google.generativeai as genai
+except ImportError:
+    genai = None
+try:
+    from openai import AsyncOpenAI, APIError, RateLimitError
+except ImportError:
+    AsyncOpenAI = None
+    APIError = None
+    RateLimitError = None
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+OLLAMA_POOL_SIZE = 4
+MAX_CONCURRENT_REQUESTS = 4
+# How long shutdown waits for clean-up tasks (closing clients) before stopping the loop
+SHUTDOWN_TIMEOUT_S = 5
+
+# How long Gemini keeps a cached system instruction, and how long Ollama keeps the model (and its prompt cache) loaded
+GEMINI_CACHE_TTL_S = 60 * 60
+DEFAULT_OLLAMA_KEEP_ALIVE = "30m"
+# Loading a large model from disk can take minutes on slow machines
+OLLAMA_LOAD_TIMEOUT_S = 300
+
+# Ollama endpoint pool: how often endpoints are health-probed, and how many more requests in flight a
+# conversation accepts on its own node (or on a node that has the model loaded) before moving elsewhere
+OLLAMA_PROBE_INTERVAL_S = 30
+OLLAMA_PROBE_TIMEOUT_S = 3
+OLLAMA_AFFINITY_SLACK = 1
+
+def split_endpoints(endpoint):
+    """The URLs in an endpoint setting; ollama_endpoint_url may list several separated by commas or spaces."""
+    return [url.rstrip("/") for url in re.split(r"[,\s]+", endpoint or "") if url]
+
+def client_key(settings):
+    """Returns the (api_type, api_key, endpoint, model) tuple that identifies a provider client."""
+    api_type = settings.get("api_type")
+    api_key = settings.get("api_key") or None
+    endpoint = None
+    if api_type == "OpenAI":
+        endpoint = settings.get("openai_endpoint_url") or None
+    elif api_type == "Ollama":
+        endpoint = settings.get("ollama_endpoint_url") or None
+        api_key = None
+    return (api_type, api_key, endpoint, settings.get("model"))
+
+def parse_tool_specs(system_prompt):
+    """ Reads the tool list out of SystemPrompt.txt ("## name", "Description:", "Parameters:" blocks).
+        Returns a list of {"name", "description", "params": [(name, required, description)]}.
+    """
+    tool_specs = []
+    if not system_prompt:
+        return tool_specs
+
+    tool_pattern = r'^## (\w+)[ \t]*\n+Description:[ \t]*(.+?)\s*\nParameters:(.*?)\nUsage:'
+    for match in re.finditer(tool_pattern, system_prompt, re.MULTILINE | re.DOTALL):
+        params = [
+            (param_name, requirement == "required", description.strip())
+            for param_name, requirement, description in
+            re.findall(r'^- (\w+): \((required|optional)\)[ \t]*(.*)$', match.group(3), re.MULTILINE)
+        ]
+        tool_specs.append({"name": match.group(1), "description": match.group(2).strip(), "params": params})
+    if debug_mode: print(f"DEBUG (Tools): Parsed {len(tool_specs)} tool specs from system prompt.")
+    return tool_specs
+
+def _tool_parameters_schema(tool_spec, type_names=("object", "string")):
+    object_type, string_type = type_names
+    return {
+        "type": object_type,
+        "properties": {name: {"type": string_type, "description": description} for name, _, description in tool_spec["params"]},
+        "required": [name for name, required, _ in tool_spec["params"] if required],
+    }
+
+def build_openai_tools(tool_specs):
+    """OpenAI function tools for the tool list."""
+    return [
+        {"type": "function", "function": {"name": spec["name"], "description": spec["description"], "parameters": _tool_parameters_schema(spec)}}
+        for spec in tool_specs
+    ]
+
+def build_gemini_tools(tool_specs):
+    """Gemini function declarations for the tool list."""
+    declarations = []
+    for spec in tool_specs:
+        declaration = {"name": spec["name"], "description": spec["description"]}
+        if spec["params"]:
+            declaration["parameters"] = _tool_parameters_schema(spec, ("OBJECT", "STRING"))
+        declarations.append(declaration)
+    return [{"function_declarations": declarations}]
+
+def build_ollama_format(tool_specs, allow_multiple=True):
+    """ JSON schema for Ollama's `format` option: {"tool_calls": [{"tool": name, "params": {...}}]}.
+        Ollama constrains decoding to the schema, so the reply always parses.
+    """
+    param_names = []
+    for spec in tool_specs:
+        for name, _, _ in spec["params"]:
+            if name not in param_names: param_names.append(name)
+
+    tool_call_schema = {
+        "type": "object",
+        "properties": {
+            "tool": {"type": "string", "enum": [spec["name"] for spec in tool_specs]},
+            "params": {"type": "object", "properties": {name: {"type": "string"} for name in param_names}},
+        },
+        "required": ["tool", "params"],
+    }
+    tool_calls_schema = {"type": "array", "items": tool_call_schema, "minItems": 1}
+    if not allow_multiple:
+        tool_calls_schema["maxItems"] = 1
+    return {"type": "object", "properties": {"tool_calls": tool_calls_schema}, "required": ["tool_calls"]}
+
+def tool_calls_to_text(tool_calls):
+    """ Renders structured (name, arguments) tool calls in the XML tag format of SystemPrompt.txt,
+        so history and the tool handlers see exactly what a well-formed text reply would contain.
+    """
+    rendered_calls = []
+    for tool_name, arguments in tool_calls:
+        lines = [f"<{tool_name}>"]
+        for param_name, value in (arguments or {}).items():
+            if value is None: continue
+            lines.append(f"<{param_name}>{value}</{param_name}>")
+        lines.append(f"</{tool_name}>")
+        rendered_calls.append("\n".join(lines))
+    return "\n".join(rendered_calls)
+
+def ollama_structured_to_text(content):
+    """Converts an Ollama reply produced under build_ollama_format() back into tool call text."""
+    try:
+        data = json.loads(content)
+    except (json.JSONDecodeError, TypeError):
+        return content
+    tool_calls = data.get("tool_calls") if isinstance(data, dict) else None
+    if not tool_calls:
+        return content
+    return tool_calls_to_text(
+        (call.get("tool"), call.get("params")) for call in tool_calls if isinstance(call, dict) and call.get("tool")
+    )
+
+def _to_gemini_message(msg):
+    """One standard message in Gemini's format, or None when Gemini's history leaves it out."""
+    role = msg.get("role")
+    content = msg.get("content")
+    if not content: return None
+
+    if role == "assistant":
+        role = "model"
+    elif role == "system":
+        if debug_mode: print("DEBUG (Gemini History): Skipping 'system' role message.")
+        return None
+    elif role == "tool":
+        if debug_mode: print("DEBUG (Gemini History): Treating 'tool' role message as 'user'.")
+        role = "user"
+    elif role != "user":
+        if debug_mode: print(f"DEBUG (Gemini History): Skipping unknown role '{role}'.")
+        return None
+    return {"role": role, "parts": [content]}
+
+def convert_to_gemini_history(messages):
+    """Converts standard message history to Gemini's format, reusing each message's earlier translation."""
+    gemini_history = []
+    for msg in messages:
+        entry = translate_message(msg, "gemini", _to_gemini_message)
+        if entry: gemini_history.append(entry)
+    return gemini_history
+
+def _to_openai_message(msg):
+    return {"role": msg.get("role"), "content": msg.get("content")}
+
+def convert_to_openai_messages(messages):
+    """The history as the plain dicts the OpenAI client sends, converted once per message."""
+    return [translate_message(msg, "openai", _to_openai_message) for msg in messages]
+
+def _to_ollama_message(msg):
+    """One standard message in Ollama's format, or None when it is left out."""
+    role = msg.get("role")
+    content = msg.get("content")
+    if not content and role != "assistant": return None
+
+    if role == "tool":
+         role = "user" 
+         if debug_mode: print("DEBUG (Ollama): Mapping 'tool' role to 'user'.")
+
+    if role in ["user", "assistant", "system"]:
+         return {"role": role, "content": content}
+    if debug_mode: print(f"DEBUG (Ollama): Skipping unknown role '{role}'.")
+    return None
+
+def convert_to_ollama_messages(messages):
+    """Converts standard message history to Ollama's format, reusing each message's earlier translation."""
+    ollama_messages = []
+    for msg in messages:
+        entry = translate_message(msg, "ollama", _to_ollama_message)
+        if entry: ollama_messages.append(entry)
+    return ollama_messages
+
+def _history_fingerprint(messages, length):
+    """ Cheap fingerprint of messages[:length]: its length plus its first and last message.
+        conversation_history is append-only, so this is enough to spot a reset or a replaced history.
+    """
+    if length == 0:
+        return (0, None, None)
+    first, last = messages[0], messages[length - 1]
+    return (length, first.get("role"), hash(first.get("content")), last.get("role"), hash(last.get("content")))
+
+class GeminiSessionManager:
+    """ Keeps one Gemini ChatSession per conversation and feeds it only the newest message.
+        The session is rebuilt from the full history only when the model changes or the
+        history no longer continues from what the session has already seen.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Forgets the current session, e.g. on New Chat or after a failed request."""
+        self._session = None
+        self._model = None
+        self._synced_length = 0
+        self._synced_fingerprint = None
+
+    def _continues_session(self, gemini_model, messages):
+        if self._session is None or self._model is not gemini_model:
+            return False
+        # Expected shape: <already sent history> + <the model's reply> + <new user message>
+        if len(messages) != self._synced_length + 2:
+            return False
+        if messages[self._synced_length].get("role") != "assistant":
+            return False
+        return _history_fingerprint(messages, self._synced_length) == self._synced_fingerprint
+
+    async def send_message(self, gemini_model, messages, stream=False, **send_kwargs):
+        """ Sends the last message of a standard-format history (system message already removed).
+            Returns the Gemini response object, async-iterable when stream is True.
+        """
+        last_message = messages[-1].get("content")
+        if not last_message:
+            raise ValueError("Last message in history for Gemini call is empty or missing content.")
+
+        if self._continues_session(gemini_model, messages):
+            if debug_mode: print("DEBUG (Gemini): Reusing existing chat session.")
+        else:
+            if debug_mode: print(f"DEBUG (Gemini): Starting new chat session from {len(messages) - 1} message(s).")
+            self._session = gemini_model.start_chat(history=convert_to_gemini_history(messages[:-1]))
+            self._model = gemini_model
+
+        if debug_mode: print(f"DEBUG (Gemini): Sending message: {last_message[:100]}...")
+        response = await self._session.send_message_async(last_message, stream=stream, **send_kwargs)
+
+        self._synced_length = len(messages)
+        self._synced_fingerprint = _history_fingerprint(messages, len(messages))
+        return response
+
+    def replace_last_reply(self, text):
+        """ Swaps the model's last turn in the session for plain text, e.g. a function call
+            rendered as tool call text, so the session matches conversation_history.
+        """
+        if self._session is None or not self._session.history:
+            return
+        self._session.history = list(self._session.history[:-1]) + [{"role": "model", "parts": [text]}]
+
+def prompt_prefix_key(messages):
+    """Identifies the stable prompt prefix (the first message), e.g. to route requests to the same provider cache."""
+    first = messages[0]
+    return first.digest if isinstance(first, Message) else fingerprint(first.get("role"), first.get("content"))
+
+def estimate_tokens(messages):
+    """Rough token estimate for a message list (~4 characters per token plus per-message overhead)."""
+    if isinstance(messages, HistorySnapshot):
+        return messages.estimated_tokens
+    return sum(len(str(msg.get("content") or "")) // 4 + 4 for msg in messages)
+
+def parse_reset_duration(value):
+    """ Parses rate-limit reset values such as "1s", "6m0s", "20ms" or a plain number of seconds.
+        Returns seconds as a float, or None if the value cannot be read.
+    """
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = re.findall(r'([\d.]+)(ms|h|m|s)', value)
+    if not parts:
+        return None
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(amount) * units[unit] for amount, unit in parts)
+
+def keep_alive_refresh_s(keep_alive):
+    """ How often to renew an Ollama keep_alive so the model never unloads: half its duration (at least
+        a minute), or None when it needs no renewal (negative keeps the model loaded for good, 0 unloads it).
+    """
+    if str(keep_alive).strip().startswith("-"):
+        return None
+    seconds = parse_reset_duration(keep_alive)
+    if not seconds:
+        return None
+    return max(60.0, seconds / 2)
+
+def ollama_timings(data):
+    """Model load, prompt evaluation and generation times in ms from a final Ollama response (reported in ns)."""
+    return {
+        "load_ms": round((data.get("load_duration") or 0) / 1e6),
+        "prompt_eval_ms": round((data.get("prompt_eval_duration") or 0) / 1e6),
+        "eval_ms": round((data.get("eval_duration") or 0) / 1e6)
+    }
+
+def parse_retry_delay(error_text):
+    """Pulls the suggested retry delay (seconds) out of a quota error message, e.g. Gemini's ResourceExhausted."""
+    if not error_text:
+        return None
+    match = re.search(r'retry_delay\s*\{\s*seconds:\s*(\d+)', error_text) or \
+            re.search(r'retry (?:in|after) ([\d.]+)\s*s', error_text, re.IGNORECASE)
+    return float(match.group(1)) if match else None
+
+class RateLimiter:
+    """ Per-provider token-bucket limiter with a requests-per-minute bucket, a tokens-per-minute
+        bucket and a minimum gap between calls (the "Rate Limit (seconds)" setting). A budget of 0
+        disables that bucket. Rate-limit headers, Retry-After and quota errors reported by the
+        provider block further calls until the reported reset time.
+        reserve() books a call's slot under the lock, so concurrent callers queue up behind each
+        other instead of all seeing the same free slot.
+    """
+
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0, min_interval=0):
+        self._lock = threading.Lock()
+        self.requests_per_minute = 0
+        self.tokens_per_minute = 0
+        self.min_interval = 0
+        self._request_level = 0.0
+        self._token_level = 0.0
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._last_start = float("-inf")
+        self.configure(requests_per_minute, tokens_per_minute, min_interval)
+
+    def configure(self, requests_per_minute, tokens_per_minute, min_interval):
+        """Applies new budgets; a bucket whose size changed starts full."""
+        with self._lock:
+            if requests_per_minute != self.requests_per_minute:
+                self.requests_per_minute = requests_per_minute
+                self._request_level = float(requests_per_minute)
+            if tokens_per_minute != self.tokens_per_minute:
+                self.tokens_per_minute = tokens_per_minute
+                self._token_level = float(tokens_per_minute)
+            self.min_interval = min_interval
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._updated = now
+        if self.requests_per_minute:
+            self._request_level = min(self.requests_per_minute, self._request_level + elapsed * self.requests_per_minute / 60)
+        if self.tokens_per_minute:
+            self._token_level = min(self.tokens_per_minute, self._token_level + elapsed * self.tokens_per_minute / 60)
+
+    def _wait(self, now, estimated_tokens):
+        """Seconds from now until the next call may start, given the current (possibly overdrawn) buckets."""
+        waits = [0.0, self._blocked_until - now, self._last_start + self.min_interval - now]
+        if self.requests_per_minute and self._request_level < 1:
+            waits.append((1 - self._request_level) * 60 / self.requests_per_minute)
+        if self.tokens_per_minute:
+            needed = min(estimated_tokens, self.tokens_per_minute)
+            if self._token_level < needed:
+                waits.append((needed - self._token_level) * 60 / self.tokens_per_minute)
+        return max(waits)
+
+    def delay_for(self, estimated_tokens=0):
+        """Seconds until a request of about estimated_tokens could be sent (0 if it may go now), without booking it."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            return self._wait(now, estimated_tokens)
+
+    def reserve(self, estimated_tokens=0):
+        """ Books the next free slot for a request of about estimated_tokens. Returns (seconds to wait
+            before sending it, tokens taken from the bucket); pass the latter to record_usage() once
+            the call's real usage is known. The buckets are debited at once (they may go negative),
+            so the next caller's wait already includes this reservation.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait_s = self._wait(now, estimated_tokens)
+            if self.requests_per_minute:
+                self._request_level -= 1
+            reserved_tokens = min(estimated_tokens, self.tokens_per_minute) if self.tokens_per_minute else 0
+            self._token_level -= reserved_tokens
+            self._last_start = now + wait_s
+            return wait_s, reserved_tokens
+
+    def blocked_for(self):
+        """Seconds left on a block reported by the provider (Retry-After, quota errors)."""
+        with self._lock:
+            return max(0.0, self._blocked_until - time.monotonic())
+
+    def record_usage(self, total_tokens, reserved_tokens=0):
+        """Corrects the token bucket with the usage the provider reported for a call that reserved reserved_tokens."""
+        if not total_tokens or not self.tokens_per_minute:
+            return
+        with self._lock:
+            self._token_level -= total_tokens - reserved_tokens
+
+    def block_for(self, seconds):
+        """Holds every call for at least the given number of seconds (Retry-After, quota errors)."""
+        if not seconds or seconds <= 0:
+            return
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        if debug_mode: print(f"DEBUG (RateLimiter): Provider asked to wait {seconds:.1f}s.")
+
+    def update_from_headers(self, headers):
+        """ Adapts to Retry-After and x-ratelimit-* headers (OpenAI-compatible APIs). """
+        if not headers:
+            return
+        retry_after = parse_reset_duration(headers.get("retry-after"))
+        if retry_after:
+            self.block_for(retry_after)
+
+        for kind in ("requests", "tokens"):
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            if remaining is None:
+                continue
+            try:
+                remaining = float(remaining)
+            except ValueError:
+                continue
+            with self._lock:
+                if kind == "requests" and self.requests_per_minute:
+                    self._request_level = min(self._request_level, remaining)
+                elif kind == "tokens" and self.tokens_per_minute:
+                    self._token_level = min(self._token_level, remaining)
+            if remaining < 1:
+                self.block_for(parse_reset_duration(headers.get(f"x-ratelimit-reset-{kind}")))
+
+class RequestCancelled(Exception):
+    """Raised inside a provider call whose CancelToken was cancelled."""
+
+class CancelToken:
+    """ Thread-safe cancellation handle for one in-flight request. Closers registered with
+        on_cancel() (e.g. AsyncEngine cancelling the request's task) run once on cancel(), which
+        tears the connection down at once instead of letting the generation finish in the background.
+    """
+
+    def __init__(self):
+        self._cancelled = threading.Event()
+        self._closers = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        with self._lock:
+            if self._cancelled.is_set():
+                return
+            self._cancelled.set()
+            closers = list(self._closers)
+            self._closers.clear()
+        for closer in closers:
+            try:
+                closer()
+            except Exception as e:
+                if debug_mode: print(f"DEBUG (Cancel): Error while closing cancelled request: {e}")
+
+    def on_cancel(self, closer):
+        """ Registers closer to run on cancel() (immediately if already cancelled).
+            Returns a function that unregisters it once the call is done with the resource.
+        """
+        with self._lock:
+            if not self._cancelled.is_set():
+                self._closers.append(closer)
+                def unregister():
+                    with self._lock:
+                        if closer in self._closers: self._closers.remove(closer)
+                return unregister
+        closer()
+        return lambda: None
+
+    def raise_if_cancelled(self):
+        if self._cancelled.is_set():
+            raise RequestCancelled()
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+def error_status_code(error):
+    """Best-effort HTTP status code of a provider exception (OpenAI, httpx or google-api-core)."""
+    for candidate in (getattr(error, "status_code", None), getattr(getattr(error, "response", None), "status_code", None), getattr(error, "code", None)):
+        if isinstance(candidate, int):
+            return candidate
+    cause = error.__cause__ or error.__context__
+    if cause is not None and cause is not error:
+        return error_status_code(cause)
+    return None
+
+def is_retryable_error(error):
+    """True for transient failures worth retrying or failing over: 429/5xx, timeouts and dropped connections."""
+    if isinstance(error, (ImportError, ValueError, RequestCancelled)):
+        return False
+    status_code = error_status_code(error)
+    if status_code is not None:
+        return status_code in RETRYABLE_STATUS_CODES
+    message = str(error).lower()
+    return any(marker in message for marker in (
+        "429", "500", "502", "503", "504", "rate limit", "resource exhausted", "resourceexhausted", "quota",
+        "unavailable", "overloaded", "timed out", "timeout", "could not connect", "connection"
+    ))
+
+def backoff_delay(attempt, base_delay=1.0, max_delay=20.0):
+    """Exponential backoff with full jitter for the given (0-based) retry attempt."""
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+class CircuitBreaker:
+    """ Stops sending requests to a backend that keeps failing. After failure_threshold consecutive
+        transient failures the breaker opens for reset_timeout seconds, then lets one trial request through
+        (half-open): its success closes the breaker, its failure opens it again. A trial that never
+        reports back, e.g. because it was cancelled, is replaced by a new one after reset_timeout.
+    """
+
+    def __init__(self, failure_threshold=3, reset_timeout=60.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_started = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """True if a request may be sent: the breaker is closed, or this caller gets the half-open trial."""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            now = time.monotonic()
+            if now - self._opened_at < self.reset_timeout:
+                return False
+            if self._trial_started is not None and now - self._trial_started < self.reset_timeout:
+                return False
+            self._trial_started = now
+            if debug_mode: print("DEBUG (CircuitBreaker): Half-open, letting one trial request through.")
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_started = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._trial_started = None
+                if debug_mode: print(f"DEBUG (CircuitBreaker): Opened after {self._failures} consecutive failures.")
+
+def _ollama_model_name(model):
+    """Ollama's full name for a model: "llama3" is listed as "llama3:latest"."""
+    return model if not model or ":" in model else f"{model}:latest"
+
+class OllamaEndpoint:
+    """Routing state of one Ollama server in an OllamaEndpointPool."""
+    __slots__ = ("url", "in_flight", "healthy", "models", "loaded_models", "latency_s", "last_probe")
+
+    def __init__(self, url):
+        self.url = url
+        self.in_flight = 0
+        self.healthy = True
+        self.models = None          # installed models from /api/tags, None until probed
+        self.loaded_models = set()  # models in memory (from /api/ps, plus ones it has served since)
+        self.latency_s = None       # moving average of request latency
+        self.last_probe = 0.0
+
+    def has_model(self, model):
+        return self.models is None or _ollama_model_name(model) in self.models
+
+    def to_dict(self):
+        return {
+            "url": self.url, "healthy": self.healthy, "in_flight": self.in_flight,
+            "loaded_models": sorted(self.loaded_models),
+            "latency_s": round(self.latency_s, 3) if self.latency_s is not None else None
+        }
+
+class OllamaEndpointPool:
+    """ Spreads Ollama requests over several servers. Endpoints are health-probed with /api/tags (which
+        also lists the models each one has, /api/ps adding the ones in memory) at most every
+        OLLAMA_PROBE_INTERVAL_S, in a background task so no request waits for a probe; requests are
+        routed on what the last probes found (every endpoint counts as healthy until probed).
+        Each request goes to a healthy endpoint that has the model, preferring
+        the node the conversation (affinity) used last and then nodes with the model already loaded,
+        as long as they are not busier than the rest by more than OLLAMA_AFFINITY_SLACK; otherwise
+        the endpoint with the fewest requests in flight, weighted by its average latency.
+        A single endpoint is used as is, without probes.
+    """
+
+    def __init__(self, urls, client_registry, max_affinities=1024):
+        self.endpoints = [OllamaEndpoint(url) for url in urls]
+        self.client_registry = client_registry
+        self.max_affinities = max_affinities
+        self._affinity = collections.OrderedDict()
+        self._next = 0
+        self._refreshing = None
+
+    def _get(self, url):
+        return next((endpoint for endpoint in self.endpoints if endpoint.url == url), None)
+
+    async def _probe(self, endpoint):
+        client = self.client_registry.get_client("Ollama", None, endpoint.url, None)
+        endpoint.last_probe = time.monotonic()
+        try:
+            response = await client.get(f"{endpoint.url}/api/tags", timeout=OLLAMA_PROBE_TIMEOUT_S)
+            response.raise_for_status()
+            endpoint.models = {model.get("name") for model in response.json().get("models", [])}
+            endpoint.healthy = True
+        except Exception as e:
+            if debug_mode and endpoint.healthy: print(f"DEBUG (OllamaPool): {endpoint.url} failed its health probe: {e}")
+            endpoint.healthy = False
+            endpoint.loaded_models.clear()
+            return
+        try:
+            response = await client.get(f"{endpoint.url}/api/ps", timeout=OLLAMA_PROBE_TIMEOUT_S)
+            response.raise_for_status()
+            endpoint.loaded_models = {model.get("name") for model in response.json().get("models", [])}
+        except Exception:
+            pass
+
+    def _due(self, force=False):
+        if len(self.endpoints) < 2:
+            return []
+        cutoff = time.monotonic() - OLLAMA_PROBE_INTERVAL_S
+        return [endpoint for endpoint in self.endpoints if force or endpoint.last_probe <= cutoff]
+
+    async def refresh(self, force=False):
+        """Probes every endpoint whose last probe is older than OLLAMA_PROBE_INTERVAL_S (all of them when force is set)."""
+        due = self._due(force)
+        if due:
+            await asyncio.gather(*(self._probe(endpoint) for endpoint in due))
+
+    def refresh_in_background(self):
+        """Starts refresh() as a task on the running loop when probes are due and none are running yet."""
+        if (self._refreshing is None or self._refreshing.done()) and self._due():
+            self._refreshing = asyncio.ensure_future(self.refresh())
+        return self._refreshing
+
+    def _score(self, endpoint):
+        return (endpoint.in_flight + 1) * (endpoint.latency_s or 1.0)
+
+    def select(self, model, affinity=None):
+        """Picks the endpoint URL for a request (see the class docstring) without probing."""
+        if len(self.endpoints) == 1:
+            return self.endpoints[0].url
+        healthy = [endpoint for endpoint in self.endpoints if endpoint.healthy] or self.endpoints
+        candidates = [endpoint for endpoint in healthy if endpoint.has_model(model)] or healthy
+        least_busy = min(endpoint.in_flight for endpoint in candidates) + OLLAMA_AFFINITY_SLACK
+
+        preferred = self._get(self._affinity.get(affinity)) if affinity is not None else None
+        if preferred in candidates and preferred.in_flight <= least_busy:
+            return preferred.url
+
+        full_name = _ollama_model_name(model)
+        warm = [endpoint for endpoint in candidates if full_name in endpoint.loaded_models and endpoint.in_flight <= least_busy]
+        pool = warm or candidates
+        # Rotate the starting point so equally scored endpoints take turns
+        self._next = (self._next + 1) % len(pool)
+        rotated = pool[self._next:] + pool[:self._next]
+        return min(rotated, key=self._score).url
+
+    async def acquire(self, model, affinity=None):
+        """ Returns the endpoint URL to send a request to and counts the request as in flight there.
+            Due probes are started in the background; this request is routed on the current state.
+        """
+        self.refresh_in_background()
+        url = self.select(model, affinity)
+        endpoint = self._get(url)
+        endpoint.in_flight += 1
+        if affinity is not None:
+            self._affinity[affinity] = url
+            self._affinity.move_to_end(affinity)
+            while len(self._affinity) > self.max_affinities:
+                self._affinity.popitem(last=False)
+        if debug_mode and len(self.endpoints) > 1: print(f"DEBUG (OllamaPool): Routing {model} to {url} ({endpoint.in_flight} in flight).")
+        return url
+
+    def release(self, url, model, latency_s, error=None):
+        """ Ends a request started with acquire(). A success marks the model as loaded on the endpoint
+            and updates its latency; a dropped connection, timeout or overload marks it unhealthy
+            until its next probe.
+        """
+        endpoint = self._get(url)
+        if endpoint is None:
+            return
+        endpoint.in_flight = max(0, endpoint.in_flight - 1)
+        if error is None:
+            endpoint.healthy = True
+            endpoint.loaded_models.add(_ollama_model_name(model))
+            endpoint.latency_s = latency_s if endpoint.latency_s is None else 0.7 * endpoint.latency_s + 0.3 * latency_s
+        elif len(self.endpoints) > 1 and is_retryable_error(error) and error_status_code(error) != 429:
+            if debug_mode: print(f"DEBUG (OllamaPool): Taking {url} out of rotation until its next probe: {error}")
+            endpoint.healthy = False
+            endpoint.last_probe = time.monotonic()
+
+    def status(self):
+        return [endpoint.to_dict() for endpoint in self.endpoints]
+
+class AsyncEngine:
+    """ Runs provider requests as tasks on one shared background asyncio event loop instead of
+        one OS thread per request. At most max_concurrency provider calls are in flight at once
+        (see slot()); callers on other threads get a concurrent.futures.Future and cancel through
+        a CancelToken.
+    """
+
+    def __init__(self, max_concurrency=MAX_CONCURRENT_REQUESTS):
+        self.max_concurrency = max_concurrency
+        self._loop = None
+        self._semaphore = None
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self):
+        """Starts the loop thread on first use and returns the running loop."""
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                ready = threading.Event()
+
+                def run_loop():
+                    asyncio.set_event_loop(loop)
+                    self._semaphore = asyncio.Semaphore(self.max_concurrency)
+                    loop.call_soon(ready.set)
+                    loop.run_forever()
+                    loop.close()
+
+                threading.Thread(target=run_loop, name="AsyncEngine", daemon=True).start()
+                ready.wait()
+                self._loop = loop
+                if debug_mode: print(f"DEBUG (AsyncEngine): Event loop started (max {self.max_concurrency} concurrent requests).")
+            return self._loop
+
+    def slot(self):
+        """ One of the max_concurrency request slots, as an async context manager. Tasks take it only
+            around the provider call itself, so ones waiting on a rate limit or warming up a model
+            do not hold slots that real requests need.
+        """
+        return self._semaphore
+
+    def submit(self, coro, cancel_token=None):
+        """ Schedules coro on the loop and returns a concurrent.futures.Future.
+            Cancelling cancel_token cancels the task, which aborts any request it is awaiting.
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+        if cancel_token:
+            unregister = cancel_token.on_cancel(future.cancel)
+            future.add_done_callback(lambda _: unregister())
+        return future
+
+    def run(self, coro, cancel_token=None, timeout=None):
+        """Blocking form of submit() for callers that want the result directly."""
+        return self.submit(coro, cancel_token).result(timeout)
+
+    def shutdown(self, wait_for=()):
+        """ Cancels every outstanding task and stops the loop thread, first giving the futures in
+            wait_for (e.g. the client clean-up from ProviderDispatcher.reset()) up to SHUTDOWN_TIMEOUT_S.
+        """
+        if wait_for:
+            concurrent.futures.wait(wait_for, timeout=SHUTDOWN_TIMEOUT_S)
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+
+        def stop_loop():
+            for task in asyncio.all_tasks(loop):
+                task.cancel()
+            loop.stop()
+        loop.call_soon_threadsafe(stop_loop)
+
+async def _delete_gemini_caches(cached_contents):
+    """Deletes cached Gemini system instructions that are no longer used instead of waiting for their TTL."""
+    for cached_content in cached_contents:
+        try:
+            await asyncio.to_thread(cached_content.delete)
+        except Exception as e:
+            if debug_mode: print(f"DEBUG (Clients): Error deleting Gemini cached content: {e}")
+
+async def _close_clients(clients):
+    for client in clients:
+        try:
+            close = getattr(client, "aclose", None) or client.close
+            await close()
+        except Exception as e:
+            if debug_mode: print(f"DEBUG (Clients): Error closing client: {e}")
+
+class ClientRegistry:
+    """ Keeps async provider clients alive across turns so their keep-alive connection pools stay warm.
+        Clients are keyed by (api_type, api_key, endpoint, model), bound to the engine's event loop
+        and only closed by reset().
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._clients = {}
+        self._gemini_models = {}
+        self._gemini_caches = {}
+        self._gemini_configured_key = None
+        self._lock = threading.Lock()
+
+    def get_client(self, api_type, api_key, endpoint, model, system_instruction=None):
+        """ Returns the pooled client for the given provider, creating it on first use.
+            OpenAI -> AsyncOpenAI client, Gemini -> GenerativeModel, Ollama -> httpx.AsyncClient.
+        """
+        key = (api_type, api_key, endpoint, model)
+        with self._lock:
+            if api_type == "Gemini":
+                return self._get_gemini_model(key, system_instruction)
+
+            client = self._clients.get(key)
+            if client is None:
+                client = self._create_client(api_type, api_key, endpoint)
+                self._clients[key] = client
+                if debug_mode: print(f"DEBUG (Clients): Created {api_type} client for {endpoint or 'default endpoint'}.")
+            return client
+
+    def _create_client(self, api_type, api_key, endpoint):
+        if api_type == "OpenAI":
+            if not AsyncOpenAI: raise ImportError("OpenAI library not installed.")
+            client_args = {"api_key": api_key}
+            if endpoint: client_args["base_url"] = endpoint
+            return AsyncOpenAI(**client_args)
+        elif api_type == "Ollama":
+            if not httpx: raise ImportError("httpx library not installed.")
+            limits = httpx.Limits(max_connections=OLLAMA_POOL_SIZE, max_keepalive_connections=OLLAMA_POOL_SIZE)
+            return httpx.AsyncClient(limits=limits)
+        raise ValueError(f"Unsupported API type: {api_type}")
+
+    def _get_gemini_model(self, key, system_instruction):
+        if not genai: raise ImportError("Google Generative AI library not installed.")
+        api_key, model = key[1], key[3]
+
+        if self._gemini_configured_key != api_key:
+            try: genai.configure(api_key=api_key)
+            except Exception as e: raise RuntimeError(f"Failed to configure Gemini API: {e}")
+            self._gemini_configured_key = api_key
+            self._gemini_models.clear()
+            self._gemini_caches.clear()
+            if debug_mode: print("DEBUG (Clients): Configured Gemini API key.")
+
+        model_key = (key, system_instruction)
+        gemini_model = self._gemini_models.get(model_key)
+        if gemini_model is None:
+            gemini_model = genai.GenerativeModel(model_name=model, system_instruction=system_instruction)
+            self._gemini_models[model_key] = gemini_model
+        return gemini_model
+
+    async def get_gemini_model(self, api_key, model, system_instruction, cache_prefix=False):
+        """ Returns the GenerativeModel for model and system_instruction. With cache_prefix the system
+            instruction is stored as Gemini cached content (renewed before its TTL runs out), so it is
+            not processed again on every request. Models or prompts Gemini cannot cache, e.g. ones
+            below its minimum size, get the plain model from then on. Requests that pass tools must
+            use the plain model, since Gemini does not accept tools alongside cached content.
+        """
+        plain_model = self.get_client("Gemini", api_key, None, model, system_instruction=system_instruction)
+        caching = getattr(genai, "caching", None)
+        if not cache_prefix or not system_instruction or caching is None:
+            return plain_model
+
+        cache_key = (api_key, model, fingerprint(system_instruction))
+        with self._lock:
+            if cache_key in self._gemini_caches:
+                entry = self._gemini_caches[cache_key]
+                if entry is None:
+                    return plain_model
+                if entry[1] > time.monotonic():
+                    return entry[0]
+
+        try:
+            cached_content = await asyncio.to_thread(
+                caching.CachedContent.create,
+                model=model if model.startswith("models/") else f"models/{model}",
+                system_instruction=system_instruction,
+                ttl=datetime.timedelta(seconds=GEMINI_CACHE_TTL_S)
+            )
+            cached_model = genai.GenerativeModel.from_cached_content(cached_content=cached_content)
+        except Exception as e:
+            if debug_mode: print(f"DEBUG (Clients): Gemini cannot cache the system instruction for {model}, sending it inline: {e}")
+            with self._lock:
+                self._gemini_caches[cache_key] = None
+            return plain_model
+
+        if debug_mode: print(f"DEBUG (Clients): Cached the Gemini system instruction for {model} ({GEMINI_CACHE_TTL_S}s).")
+        with self._lock:
+            self._gemini_caches[cache_key] = (cached_model, time.monotonic() + GEMINI_CACHE_TTL_S - 60, cached_content)
+        return cached_model
+
+    async def warm_ollama_model(self, endpoint, model, keep_alive=None):
+        """ Loads model into Ollama's memory with an empty generate request, keeping it loaded for
+            keep_alive. Returns its timings (see ollama_timings); load_ms is 0 when it was already loaded.
+        """
+        client = self.get_client("Ollama", None, endpoint, model)
+        payload = {"model": model, "keep_alive": keep_alive if keep_alive is not None else DEFAULT_OLLAMA_KEEP_ALIVE}
+        response = await client.post(f"{endpoint.rstrip('/')}/api/generate", json=payload, timeout=OLLAMA_LOAD_TIMEOUT_S)
+        response.raise_for_status()
+        timings = ollama_timings(response.json())
+        if debug_mode: print(f"DEBUG (Clients): Ollama model '{model}' is loaded (load took {timings['load_ms']} ms, keep_alive {payload['keep_alive']}).")
+        return timings
+
+    async def _prewarm_ollama(self, url, model, keep_alive):
+        client = self.get_client("Ollama", None, url, model)
+        await client.get(f"{url}/api/version", timeout=5)
+        if model:
+            return await self.warm_ollama_model(url, model, keep_alive)
+        return None
+
+    async def prewarm(self, api_type, api_key, endpoint, model, keep_alive=None):
+        """ Opens the provider connection ahead of the first real request.
+            Runs a cheap metadata call; for Ollama the model is also loaded on every listed endpoint
+            (see warm_ollama_model) and the slowest load's timings are returned. Failures are
+            ignored since the real call reports them.
+        """
+        timings = None
+        try:
+            if api_type == "OpenAI":
+                if not api_key: return
+                await self.get_client(api_type, api_key, endpoint, model).models.list()
+            elif api_type == "Gemini":
+                if not api_key or not model: return
+                self.get_client(api_type, api_key, endpoint, model)
+                await asyncio.to_thread(genai.get_model, model if model.startswith("models/") else f"models/{model}")
+            elif api_type == "Ollama":
+                if not endpoint: return
+                results = await asyncio.gather(*(self._prewarm_ollama(url, model, keep_alive) for url in split_endpoints(endpoint)), return_exceptions=True)
+                loaded = [result for result in results if isinstance(result, dict)]
+                if not loaded and results and isinstance(results[0], Exception):
+                    raise results[0]
+                timings = max(loaded, key=lambda result: result["load_ms"], default=None)
+            if debug_mode: print(f"DEBUG (Clients): Prewarmed {api_type} connection.")
+        except Exception as e:
+            if debug_mode: print(f"DEBUG (Clients): Prewarm of {api_type} failed: {e}")
+        return timings
+
+    def prewarm_async(self, api_type, api_key, endpoint, model, keep_alive=None):
+        """Runs prewarm() on the engine's loop so the GUI never waits on it. Returns its future."""
+        return self.engine.submit(self.prewarm(api_type, api_key, endpoint, model, keep_alive))
+
+    def reset(self):
+        """ Closes every pooled client. Called when the relevant settings change.
+            Returns the futures of the clean-up tasks it started.
+        """
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+            self._gemini_models.clear()
+            gemini_caches = [entry[2] for entry in self._gemini_caches.values() if entry]
+            self._gemini_caches.clear()
+            self._gemini_configured_key = None
+
+        futures = []
+        if clients:
+            futures.append(self.engine.submit(_close_clients(clients)))
+        if gemini_caches:
+            futures.append(self.engine.submit(_delete_gemini_caches(gemini_caches)))
+        if debug_mode: print(f"DEBUG (Clients): Closing {len(clients)} pooled client(s).")
+        return futures
+
+def _report_usage(usage, prompt_tokens, completion_tokens, cached_tokens=0):
+    """ Adds one call's token usage to the usage dict (may be None); the dispatcher settles it with the
+        rate limiter. cached_tokens counts the prompt tokens the provider served from its prompt cache.
+    """
+    prompt_tokens, completion_tokens, cached_tokens = prompt_tokens or 0, completion_tokens or 0, cached_tokens or 0
+    if usage is not None:
+        usage["prompt_tokens"] = usage.get("prompt_tokens", 0) + prompt_tokens
+        usage["completion_tokens"] = usage.get("completion_tokens", 0) + completion_tokens
+        usage["total_tokens"] = usage.get("total_tokens", 0) + prompt_tokens + completion_tokens
+        usage["cached_tokens"] = usage.get("cached_tokens", 0) + cached_tokens
+    if debug_mode and cached_tokens: print(f"DEBUG (Usage): {cached_tokens} of {prompt_tokens} prompt tokens came from the provider's prompt cache.")
+
+def _record_openai_usage(completion_usage, usage):
+    """Reports the token usage of an OpenAI completion, including prompt cache hits when reported."""
+    details = getattr(completion_usage, "prompt_tokens_details", None)
+    _report_usage(usage, completion_usage.prompt_tokens, completion_usage.completion_tokens, getattr(details, "cached_tokens", 0))
+
+def _record_gemini_usage(response, usage):
+    """Reports the token usage of a Gemini response."""
+    metadata = getattr(response, "usage_metadata", None)
+    if metadata:
+        _report_usage(usage, getattr(metadata, "prompt_token_count", 0), getattr(metadata, "candidates_token_count", 0),
+                      getattr(metadata, "cached_content_token_count", 0))
+
+class ProviderDispatcher:
+    """ Sends chat requests to the configured provider on the async engine, with pooled clients,
+        per-provider rate limiters, retries with backoff, circuit breakers and failover backends.
+        An Ollama backend may list several endpoints, which share its load (see OllamaEndpointPool).
+        Holds no GUI or conversation state, so the GUI, the batch CLI and any other front end
+        can share one dispatcher (and so one set of connections and rate budgets).
+    """
+
+    def __init__(self, engine, coalescer=None):
+        self.engine = engine
+        self.client_registry = ClientRegistry(engine)
+        self.coalescer = coalescer
+        self.rate_limiters = {}
+        self.circuit_breakers = {}
+        self.ollama_pools = {}
+
+    def get_ollama_pool(self, endpoint):
+        """Returns the endpoint pool for an Ollama endpoint setting (one or more URLs)."""
+        pool = self.ollama_pools.get(endpoint)
+        if pool is None:
+            urls = split_endpoints(endpoint)
+            if not urls: raise ValueError("Ollama Endpoint URL is missing.")
+            pool = self.ollama_pools[endpoint] = OllamaEndpointPool(urls, self.client_registry)
+        return pool
+
+    def get_rate_limiter(self, settings, api_type=None):
+        """ Returns the rate limiter for an API type (default: the configured one). The configured budgets
+            apply to the configured API type; failover providers are only limited by what they report.
+        """
+        api_type = api_type or settings.get("api_type")
+        limiter = self.rate_limiters.get(api_type)
+        if limiter is None:
+            limiter = self.rate_limiters[api_type] = RateLimiter()
+        if api_type == settings.get("api_type"):
+            limiter.configure(
+                settings.get("requests_per_minute", 0),
+                settings.get("tokens_per_minute", 0),
+                settings.get("rate_limit_seconds", 1)
+            )
+        return limiter
+
+    async def request(self, settings, history, on_delta=None, reset_stream=None, tool_specs=None, allow_multiple=True,
+                      gemini_sessions=None, on_status=None, usage=None, affinity=None):
+        """ Gets one reply for history from the first backend that answers (must run on the engine's loop).
+            Identical requests in flight at the same time share one call when a coalescer is set
+            (see ResponseCache.coalesce for what callers that join a shared call receive).
+            on_status receives retry/failover notices; usage (a dict) receives the token counts.
+            affinity (e.g. a conversation id) keeps requests on the same Ollama endpoint where possible.
+            Returns (content, raw_response_for_debug, api_type, model).
+        """
+        def call(on_delta, reset_stream, on_status):
+            return self._call_backends(settings, history, on_delta, reset_stream, tool_specs, allow_multiple, gemini_sessions, on_status, usage, affinity)
+
+        if not self.coalescer:
+            return await call(on_delta, reset_stream, on_status)
+        history_key = history.fingerprint if isinstance(history, HistorySnapshot) else history
+        request_key = fingerprint(self.get_backends(settings), history_key, tool_specs is not None, allow_multiple)
+        return await self.coalescer.coalesce(request_key, call, on_delta, reset_stream, on_status)
+
+    def reset(self):
+        """ Closes every pooled client, e.g. when the provider connection settings change.
+            Returns the futures of the clean-up tasks (see AsyncEngine.shutdown).
+        """
+        self.ollama_pools.clear()
+        return self.client_registry.reset()
+
+    def get_backends(self, settings):
+        """ Ordered list of backends to try: the configured provider, then the "failover_backends"
+            entries from the config file (same keys as the settings, e.g. api_type, api_key, model).
+        """
+        backends = [client_key(settings)]
+        for backend_settings in settings.get("failover_backends", []):
+            backend = client_key(backend_settings)
+            if backend[0] and backend not in backends:
+                backends.append(backend)
+        return backends
+
+    def get_circuit_breaker(self, backend):
+        breaker = self.circuit_breakers.get(backend)
+        if breaker is None:
+            breaker = self.circuit_breakers[backend] = CircuitBreaker()
+        return breaker
+
+    async def _call_backend(self, settings, backend, current_history, on_delta, tool_specs, allow_multiple, rate_limiter, gemini_sessions, usage, affinity=None):
+        """Sends one request to one backend. Returns (content, raw_response_for_debug)."""
+        api_type, api_key, endpoint, model = backend
+        provider_args = {"on_delta": on_delta, "tool_specs": tool_specs, "allow_multiple": allow_multiple, "rate_limiter": rate_limiter, "usage": usage}
+        prompt_caching = settings.get("prompt_caching", True)
+        if api_type == "OpenAI":
+            if not AsyncOpenAI: raise ImportError("OpenAI library not installed.")
+            return await self.openai_response(current_history, api_key, model, endpoint, prompt_caching=prompt_caching, **provider_args)
+        elif api_type == "Gemini":
+            if not genai: raise ImportError("Google Generative AI library not installed.")
+            return await self.gemini_response(current_history, api_key, model, gemini_sessions=gemini_sessions, prompt_caching=prompt_caching, **provider_args)
+        elif api_type == "Ollama":
+            if not httpx: raise ImportError("httpx library not installed.")
+            keep_alive = settings.get("ollama_keep_alive", DEFAULT_OLLAMA_KEEP_ALIVE)
+            pool = self.get_ollama_pool(endpoint)
+            url = await pool.acquire(model, affinity)
+            started, error = time.monotonic(), None
+            try:
+                return await self.ollama_response(current_history, model, url, keep_alive=keep_alive, **provider_args)
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                pool.release(url, model, time.monotonic() - started, error)
+        raise ValueError(f"Unsupported API type: {api_type}")
+
+    async def _call_backend_with_retries(self, settings, backend, current_history, on_delta, reset_stream, tool_specs, allow_multiple, gemini_sessions, on_status, usage, affinity=None):
+        """ Calls one backend, retrying transient errors with jittered exponential backoff.
+            Returns (content, raw_response_for_debug, error); error is None on success.
+        """
+        api_type = backend[0]
+        breaker = self.get_circuit_breaker(backend)
+        rate_limiter = self.get_rate_limiter(settings, api_type)
+        estimated_tokens = estimate_tokens(current_history)
+        max_retries = settings.get("max_retries", 2)
+        last_error = None
+
+        for attempt in range(max_retries + 1):
+            wait_s, reserved_tokens = rate_limiter.reserve(estimated_tokens)
+            if attempt:
+                wait_s = max(wait_s, backoff_delay(attempt - 1))
+                if on_status: on_status(f"⚠️ {api_type} error, retry {attempt}/{max_retries} in {wait_s:.0f}s...")
+            if wait_s > 0:
+                await asyncio.sleep(wait_s)
+            # A provider may have reported a block while this call was waiting for its slot
+            while rate_limiter.blocked_for() > 0:
+                await asyncio.sleep(rate_limiter.blocked_for())
+            if reset_stream: reset_stream()
+            call_usage = {}
+            try:
+                async with self.engine.slot():
+                    response, raw_response_for_debug = await self._call_backend(settings, backend, current_history, on_delta, tool_specs, allow_multiple, rate_limiter, gemini_sessions, call_usage, affinity)
+                breaker.record_success()
+                return response, raw_response_for_debug, None
+            except Exception as e:
+                if not is_retryable_error(e):
+                    return None, None, e
+                breaker.record_failure()
+                last_error = e
+                if debug_mode: print(f"DEBUG (Dispatcher): Transient error from {api_type} (attempt {attempt + 1}): {e}")
+                if not breaker.allow():
+                    break
+            finally:
+                # Settle this call's own reservation, whatever other calls reserved meanwhile
+                rate_limiter.record_usage(call_usage.get("total_tokens", 0), reserved_tokens)
+                if usage is not None:
+                    for name, value in call_usage.items():
+                        usage[name] = usage.get(name, 0) + value
+        return None, None, last_error
+
+    async def _call_backends(self, settings, current_history, on_delta, reset_stream, tool_specs, allow_multiple, gemini_sessions, on_status, usage, affinity=None):
+        """ Tries the primary backend, then each failover backend after transient failures.
+            Returns (content, raw_response_for_debug, api_type, model) of the backend that answered.
+        """
+        last_error = None
+        attempted_backend = False
+        for backend in self.get_backends(settings):
+            if not self.get_circuit_breaker(backend).allow():
+                if debug_mode: print(f"DEBUG (Dispatcher): Skipping {backend[0]} ({backend[3]}), circuit breaker is open.")
+                continue
+            if attempted_backend:
+                if on_status: on_status(f"↪️ Failing over to {backend[0]} ({backend[3]})...")
+                if debug_mode: print(f"DEBUG (Dispatcher): Failing over to {backend[0]} with model '{backend[3]}'.")
+            attempted_backend = True
+
+            response, raw_response_for_debug, last_error = await self._call_backend_with_retries(
+                settings, backend, current_history, on_delta, reset_stream, tool_specs, allow_multiple, gemini_sessions, on_status, usage, affinity
+            )
+            if last_error is None:
+                return response, raw_response_for_debug, backend[0], backend[3]
+            if not is_retryable_error(last_error):
+                break
+
+        if not attempted_backend:
+            raise RuntimeError("Every configured backend failed repeatedly and is paused. Try again shortly.")
+        raise last_error
+
+    async def openai_response(self, messages, api_key, model, base_url=None, on_delta=None, tool_specs=None, allow_multiple=True, rate_limiter=None, usage=None, prompt_caching=True):
+        """Gets response from OpenAI API using conversation history.
+            If on_delta is given the completion is streamed and each text chunk is passed to it.
+            If tool_specs is given the tools are offered as native function tools and the calls
+            are returned rendered as tool call text.
+            Rate-limit headers are reported to rate_limiter when given, and token
+            usage is added to the usage dict when given.
+            With prompt_caching, requests to OpenAI itself carry a prompt_cache_key for the system
+            prompt so they are routed to a server that has its prefix cached.
+        """
+        if not api_key: raise ValueError("OpenAI API Key is missing.")
+        if not model: raise ValueError("OpenAI Model name is missing.")
+        if not messages: raise ValueError("Messages list cannot be empty.")
+
+        client = self.client_registry.get_client("OpenAI", api_key, base_url or None, model)
+        cache_args = {}
+        if prompt_caching and not base_url:
+            cache_args["extra_body"] = {"prompt_cache_key": prompt_prefix_key(messages)[:32]}
+        messages = convert_to_openai_messages(messages)
+        try:
+
+            if on_delta:
+                if not base_url: cache_args["stream_options"] = {"include_usage": True}
+                raw_stream = await client.chat.completions.with_raw_response.create(model=model, messages=messages, stream=True, **cache_args)
+                if rate_limiter: rate_limiter.update_from_headers(raw_stream.headers)
+                stream = raw_stream.parse()
+                content_parts = []
+                try:
+                    async for chunk in stream:
+                        if getattr(chunk, "usage", None): _record_openai_usage(chunk.usage, usage)
+                        if not chunk.choices or not chunk.choices[0].delta: continue
+                        piece = chunk.choices[0].delta.content
+                        if piece:
+                            content_parts.append(piece)
+                            on_delta(piece)
+                finally:
+                    await stream.close()
+                return "".join(content_parts), None
+
+            request_args = dict(cache_args)
+            if tool_specs:
+                request_args["tools"] = build_openai_tools(tool_specs)
+                request_args["tool_choice"] = "required"
+                if not allow_multiple: request_args["parallel_tool_calls"] = False
+
+            raw_completion = await client.chat.completions.with_raw_response.create(model=model, messages=messages, **request_args)
+            completion = raw_completion.parse()
+            content = None
+            raw_debug_data = completion 
+
+            if rate_limiter: rate_limiter.update_from_headers(raw_completion.headers)
+            if completion.usage: _record_openai_usage(completion.usage, usage)
+
+            if completion.choices and completion.choices[0].message:
+                message = completion.choices[0].message
+                content = message.content
+                if tool_specs and message.tool_calls:
+                    structured_calls = [(call.function.name, json.loads(call.function.arguments or "{}")) for call in message.tool_calls]
+                    content = tool_calls_to_text(structured_calls if allow_multiple else structured_calls[:1])
+
+            return content, raw_debug_data if debug_mode else None 
+        except (APIError, RateLimitError) as e:
+            error_response = getattr(e, "response", None)
+            if rate_limiter and error_response is not None: rate_limiter.update_from_headers(error_response.headers)
+            raise e
+        except Exception as e: raise RuntimeError(f"OpenAI request failed: {e}")
+
+    async def gemini_response(self, messages, api_key, model, on_delta=None, tool_specs=None, allow_multiple=True, rate_limiter=None, usage=None, gemini_sessions=None, prompt_caching=True):
+         """Gets response from Google Gemini API using conversation history.
+             If on_delta is given the reply is streamed and each text chunk is passed to it.
+             If tool_specs is given the tools are offered as function declarations and the calls
+             are returned rendered as tool call text.
+             Quota errors are reported to rate_limiter when given, and token
+             usage is added to the usage dict when given.
+             gemini_sessions is the conversation's GeminiSessionManager; without one the chat
+             session is rebuilt from the full history.
+             With prompt_caching the system instruction is served from Gemini cached content.
+         """
+         if not api_key: raise ValueError("Gemini API Key is missing.")
+         if not model: raise ValueError("Gemini Model name is missing.")
+         if not messages: raise ValueError("Messages list cannot be empty.")
+
+         system_instruction = None
+         if messages and messages[0].get("role") == "system":
+              system_instruction = messages[0].get("content")
+
+              messages_for_chat = messages[1:]
+              if debug_mode: print(f"DEBUG (Gemini): Using system instruction: {system_instruction[:100]}...")
+         else:
+              messages_for_chat = messages
+
+         # Gemini rejects tools and tool_config on requests to a cached-content model, so tool calls use the plain model
+         gemini_model = await self.client_registry.get_gemini_model(api_key, model, system_instruction, cache_prefix=prompt_caching and not tool_specs)
+         gemini_sessions = gemini_sessions or GeminiSessionManager()
+
+         try:
+
+             if on_delta:
+                 response = await gemini_sessions.send_message(gemini_model, messages_for_chat, stream=True)
+                 content_parts = []
+                 async for chunk in response:
+                     try: piece = chunk.text
+                     except ValueError: continue 
+                     if piece:
+                         content_parts.append(piece)
+                         on_delta(piece)
+                 _record_gemini_usage(response, usage)
+                 return "".join(content_parts), response if debug_mode else None
+
+             send_args = {}
+             if tool_specs:
+                 send_args["tools"] = build_gemini_tools(tool_specs)
+                 send_args["tool_config"] = {"function_calling_config": {"mode": "ANY"}}
+
+             response = await gemini_sessions.send_message(gemini_model, messages_for_chat, **send_args)
+
+             content = None
+             raw_debug_data = response
+             _record_gemini_usage(response, usage)
+
+             if tool_specs and response.candidates:
+                 structured_calls = [
+                     (part.function_call.name, dict(part.function_call.args))
+                     for part in response.candidates[0].content.parts if getattr(part, "function_call", None)
+                 ]
+                 if structured_calls:
+                     content = tool_calls_to_text(structured_calls if allow_multiple else structured_calls[:1])
+                     gemini_sessions.replace_last_reply(content)
+                     return content, raw_debug_data if debug_mode else None
+
+             if hasattr(response, 'text'): content = response.text
+             elif hasattr(response, 'parts'): content = "".join(part.text for part in response.parts if hasattr(part, 'text'))
+
+             return content, raw_debug_data if debug_mode else None
+         except asyncio.CancelledError:
+             gemini_sessions.reset()
+             raise
+         except Exception as e:
+             gemini_sessions.reset()
+             err_detail = str(e)
+             if rate_limiter: rate_limiter.block_for(parse_retry_delay(err_detail))
+
+             response_obj_for_error = locals().get('response') or getattr(e, 'response', None)
+             if response_obj_for_error:
+                  try:
+                      if hasattr(response_obj_for_error, 'prompt_feedback'):
+                           feedback = getattr(response_obj_for_error, 'prompt_feedback', 'N/A')
+                           err_detail += f"\nPrompt Feedback: {feedback}"
+                      if hasattr(response_obj_for_error, 'candidates') and response_obj_for_error.candidates:
+                           finish_reason = getattr(response_obj_for_error.candidates[0], 'finish_reason', 'N/A')
+                           err_detail += f"\nFinish Reason: {finish_reason}"
+                  except Exception as e_inner:
+                      err_detail += f"\n(Could not extract extra error details: {e_inner})"
+             raise RuntimeError(f"Gemini API request failed: {err_detail}")
+
+    async def ollama_response(self, messages, model, base_url, on_delta=None, tool_specs=None, allow_multiple=True, rate_limiter=None, usage=None, keep_alive=None):
+        """Gets response from local Ollama API using conversation history.
+            The reply is always streamed over the wire so cancelling the task drops the connection,
+            which makes Ollama stop generating. If on_delta is given each text chunk is passed to it.
+            If tool_specs is given decoding is constrained to a tool call JSON schema and the
+            calls are returned rendered as tool call text.
+            Retry-After is reported to rate_limiter when given, and token
+            usage is added to the usage dict when given.
+            keep_alive (e.g. "30m") keeps the model loaded after the reply, so the next request
+            reuses its cached prompt prefix instead of reloading and re-reading the system prompt.
+        """
+        if not model: raise ValueError("Ollama Model name is missing.")
+        if not base_url: raise ValueError("Ollama Endpoint URL is missing.")
+        if not httpx: raise ImportError("httpx library not installed.")
+        if not messages: raise ValueError("Messages list cannot be empty.")
+
+        api_url = f"{base_url.rstrip('/')}/api/chat"
+
+        payload = {"model": model, "messages": convert_to_ollama_messages(messages), "stream": True}
+        if keep_alive is not None:
+            payload["keep_alive"] = keep_alive
+        if tool_specs:
+            payload["format"] = build_ollama_format(tool_specs, allow_multiple)
+
+        response = None
+        try:
+            client = self.client_registry.get_client("Ollama", None, base_url, model)
+            content_parts = []
+            final_data = None
+            async with client.stream("POST", api_url, json=payload, timeout=120) as response:
+                if response.is_error: await response.aread()
+                response.raise_for_status() 
+
+                async for line in response.aiter_lines():
+                    if not line: continue
+                    chunk_data = json.loads(line)
+                    if "error" in chunk_data:
+                        raise RuntimeError(f"Ollama API Error: {chunk_data['error']}")
+                    piece = (chunk_data.get("message") or {}).get("content")
+                    if piece:
+                        content_parts.append(piece)
+                        if on_delta: on_delta(piece)
+                    if chunk_data.get("done"):
+                        final_data = chunk_data
+                        break
+
+            if final_data is None and not content_parts:
+                raise RuntimeError("Ollama returned an unexpected response format: the stream ended without a message.")
+            if final_data:
+                _report_usage(usage, final_data.get("prompt_eval_count", 0), final_data.get("eval_count", 0))
+                timings = ollama_timings(final_data)
+                if usage is not None:
+                    for name, value in timings.items():
+                        usage[name] = usage.get(name, 0) + value
+                if debug_mode: print(f"DEBUG (Ollama): load {timings['load_ms']} ms, prompt {timings['prompt_eval_ms']} ms, generation {timings['eval_ms']} ms.")
+
+            content = "".join(content_parts)
+            if tool_specs: content = ollama_structured_to_text(content)
+            return content, final_data if debug_mode else None
+
+        except httpx.ConnectError as e:
+            raise RuntimeError(f"Could not connect to Ollama at {api_url}. Is Ollama running?") from e
+        except httpx.TimeoutException:
+             raise RuntimeError(f"Request to Ollama at {api_url} timed out.") from None
+        except httpx.HTTPStatusError as e:
+
+            err_msg = f"Ollama request failed: {e}"
+            if rate_limiter: rate_limiter.block_for(parse_reset_duration(e.response.headers.get("Retry-After")))
+            err_msg += f"\nStatus Code: {e.response.status_code}"
+            raw_resp_text = ""
+            try:
+                raw_resp_text = e.response.text
+                err_msg += f"\nResponse Body: {raw_resp_text[:500]}"
+                if len(raw_resp_text) > 500: err_msg += "..."
+            except Exception: err_msg += "\nResponse Body: <Could not decode>"
+            if debug_mode and raw_resp_text: print(f"\n--- OLLAMA FAILED RAW RESPONSE ---\n{raw_resp_text}\n----")
+            raise RuntimeError(err_msg) from e
+        except httpx.HTTPError as e:
+            raise RuntimeError(f"Ollama request failed: {e}") from e
+        except json.JSONDecodeError as e:
+
+             err_txt = str(e.doc)[:500]
+             status = response.status_code if response is not None else 'N/A'
+             if debug_mode: print(f"\n--- OLLAMA JSON DECODE ERROR (Status: {status}) ---\n{e.doc}\n----")
+             raise RuntimeError(f"Failed to decode JSON from Ollama. Status: {status}. Text: {err_txt}") from e
+
+    async def ollama_embedding(self, text, model, base_url):
+        """Embeds text with the local Ollama /api/embeddings endpoint (or the least loaded of several) and returns the vector."""
+        if not base_url: raise ValueError("Ollama Endpoint URL is missing.")
+        if not model: raise ValueError("Embedding model name is missing.")
+        if not httpx: raise ImportError("httpx library not installed.")
+
+        pool = self.get_ollama_pool(base_url)
+        url = await pool.acquire(model)
+        started, error = time.monotonic(), None
+        try:
+            client = self.client_registry.get_client("Ollama", None, url, model)
+            async with self.engine.slot():
+                response = await client.post(f"{url}/api/embeddings", json={"model": model, "prompt": text}, timeout=30)
+            response.raise_for_status()
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            pool.release(url, model, time.monotonic() - started, error)
+        embedding = response.json().get("embedding")
+        if not embedding:
+            raise RuntimeError(f"Ollama returned no embedding for model '{model}'.")
+        return embedding
@@ -0,0 +1,306 @@
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import re
+import math
+import sys
+import threading
+from array import array
+from collections import OrderedDict
+
+debug_mode = False
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DEFAULT_CACHE_SIZE = 500
+DEFAULT_SIMILARITY_THRESHOLD = 0.92
+SAVE_DELAY_S = 2.0  # Changes are written this long after the first unsaved one, batching bursts of puts
+
+def normalize_text(text):
+    """Case-folds and collapses whitespace so trivially different copies of a text compare equal."""
+    return re.sub(r'\s+', ' ', text or "").strip().casefold()
+
+def fingerprint(*parts):
+    """Stable SHA-256 hex digest of JSON-serialisable parts."""
+    encoded = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+def answer_cache_scope(api_type, model, system_prompt):
+    """Identifies what an answer depends on besides the question: (api_type, model, normalized system prompt hash)."""
+    return fingerprint(api_type, model, fingerprint(normalize_text(system_prompt)))
+
+def answer_cache_key(api_type, model, system_prompt, question):
+    """Cache key for a first question: (api_type, model, normalized system prompt hash, normalized question)."""
+    return fingerprint(answer_cache_scope(api_type, model, system_prompt), normalize_text(question))
+
+def encode_vector(vector):
+    """Packs an embedding as base64 little-endian float32, about a quarter the size of a JSON float list."""
+    packed = array("f", vector)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return base64.b64encode(packed.tobytes()).decode("ascii")
+
+def decode_vector(encoded):
+    """Unpacks an embedding stored by encode_vector; lists of floats from older cache files pass through."""
+    if not isinstance(encoded, str):
+        return encoded
+    packed = array("f")
+    packed.frombytes(base64.b64decode(encoded))
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tolist()
+
+def _unit_vector(vector):
+    if np is not None:
+        array = np.asarray(vector, dtype=np.float32)
+        norm = float(np.linalg.norm(array))
+        return array / norm if norm else None
+    norm = math.sqrt(sum(value * value for value in vector))
+    return [value / norm for value in vector] if norm else None
+
+class SemanticIndex:
+    """ Cosine-similarity index over question embeddings. Vectors are unit-normalised and stacked
+        into one NumPy matrix per group (scope + embedding model) so a lookup is a single
+        matrix-vector product. Falls back to plain Python when NumPy is not installed.
+    """
+
+    def __init__(self):
+        self._groups = {}
+
+    def add(self, group, key, vector):
+        unit = _unit_vector(vector)
+        if unit is None:
+            return
+        self.remove(key)
+        entries = self._groups.setdefault(group, {"keys": [], "vectors": [], "matrix": None})
+        entries["keys"].append(key)
+        entries["vectors"].append(unit)
+        entries["matrix"] = None
+
+    def remove(self, key):
+        for entries in self._groups.values():
+            if key in entries["keys"]:
+                index = entries["keys"].index(key)
+                del entries["keys"][index]
+                del entries["vectors"][index]
+                entries["matrix"] = None
+                return
+
+    def clear(self):
+        self._groups.clear()
+
+    def nearest(self, group, vector):
+        """Returns (key, cosine similarity) of the closest vector in group, or (None, 0.0)."""
+        entries = self._groups.get(group)
+        unit = _unit_vector(vector)
+        if not entries or not entries["keys"] or unit is None:
+            return None, 0.0
+
+        if np is not None:
+            if entries["matrix"] is None:
+                entries["matrix"] = np.vstack(entries["vectors"])
+            if entries["matrix"].shape[1] != unit.shape[0]:
+                return None, 0.0
+            scores = entries["matrix"] @ unit
+            best = int(np.argmax(scores))
+            return entries["keys"][best], float(scores[best])
+
+        best_key, best_score = None, 0.0
+        for key, stored in zip(entries["keys"], entries["vectors"]):
+            if len(stored) != len(unit):
+                continue
+            score = sum(a * b for a, b in zip(stored, unit))
+            if best_key is None or score > best_score:
+                best_key, best_score = key, score
+        return best_key, best_score
+
+class _SharedCall:
+    """ One request coalesce() runs for several callers: its task, how many callers await it and
+        their (on_delta, reset_stream, on_status) callbacks, which it relays to every one of them.
+    """
+    __slots__ = ("task", "waiters", "listeners", "streamed")
+
+    def __init__(self):
+        self.task = None
+        self.waiters = 0
+        self.listeners = []
+        self.streamed = []
+
+    def on_delta(self, text):
+        self.streamed.append(text)
+        for on_delta, _, _ in list(self.listeners):
+            if on_delta: on_delta(text)
+
+    def reset_stream(self):
+        self.streamed.clear()
+        for _, reset_stream, _ in list(self.listeners):
+            if reset_stream: reset_stream()
+
+    def on_status(self, message):
+        for _, _, on_status in list(self.listeners):
+            if on_status: on_status(message)
+
+class ResponseCache:
+    """ Exact-match cache of answered questions. Each entry holds the conversation messages
+        that answered the question (the rendered tool sequence) so they can be replayed without
+        an API call. Entries live in a bounded LRU in memory and are persisted as JSON by a
+        background timer shortly after they change; flush() writes pending changes at once.
+        Entries that carry a question embedding are also indexed for near-duplicate lookups;
+        embeddings are stored in the file as base64 float32 (see encode_vector).
+        Also coalesces identical API requests that are in flight at the same time.
+    """
+
+    def __init__(self, path, max_entries=DEFAULT_CACHE_SIZE):
+        self.path = path
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._index = SemanticIndex()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._save_timer = None
+        self._write_lock = threading.Lock()
+
+    def _load(self):
+        self._loaded = True
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+            for key, entry in stored.get("entries", []):
+                if entry.get("embedding"):
+                    entry["embedding"] = decode_vector(entry["embedding"])
+                self._entries[key] = entry
+                self._index_entry(key, entry)
+            self._evict()
+            if debug_mode: print(f"DEBUG (Cache): Loaded {len(self._entries)} cached answer(s) from {self.path}.")
+        except (json.JSONDecodeError, OSError, TypeError, ValueError) as e:
+            print(f"Warning: Could not load response cache {self.path}: {e}")
+            self._entries.clear()
+            self._index.clear()
+
+    def _index_entry(self, key, entry):
+        if entry.get("embedding") and entry.get("scope"):
+            self._index.add(fingerprint(entry["scope"], entry.get("embedding_model")), key, entry["embedding"])
+
+    def _save(self):
+        """Schedules a write of the cache (called with self._lock held); later changes join the pending write."""
+        if not self.path or self._save_timer is not None:
+            return
+        self._save_timer = threading.Timer(SAVE_DELAY_S, self._write)
+        self._save_timer.daemon = True
+        self._save_timer.start()
+
+    def _write(self):
+        with self._write_lock:
+            with self._lock:
+                self._save_timer = None
+                entries = list(self._entries.items())
+            entries = [(key, dict(entry, embedding=encode_vector(entry["embedding"])) if entry.get("embedding") else entry)
+                       for key, entry in entries]
+            temp_path = f"{self.path}.tmp"
+            try:
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    json.dump({"entries": entries}, f, ensure_ascii=False)
+                os.replace(temp_path, self.path)
+                if debug_mode: print(f"DEBUG (Cache): Saved {len(entries)} cached answer(s) to {self.path}.")
+            except OSError as e:
+                print(f"Warning: Could not save response cache {self.path}: {e}")
+
+    def flush(self):
+        """Writes pending changes now, e.g. before the program exits."""
+        with self._lock:
+            timer, self._save_timer = self._save_timer, None
+        if timer is not None:
+            timer.cancel()
+            self._write()
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            key, _ = self._entries.popitem(last=False)
+            self._index.remove(key)
+
+    def get(self, key):
+        """Returns the cached entry for key (marking it recently used) or None."""
+        with self._lock:
+            if not self._loaded: self._load()
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        """Stores an entry, evicting the least recently used ones beyond max_entries, and persists the cache."""
+        with self._lock:
+            if not self._loaded: self._load()
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self._index.remove(key)
+            self._index_entry(key, entry)
+            self._evict()
+            self._save()
+
+    def discard(self, key):
+        with self._lock:
+            if not self._loaded: self._load()
+            if self._entries.pop(key, None) is not None:
+                self._index.remove(key)
+                self._save()
+
+    def find_similar(self, scope, embedding_model, embedding, threshold=DEFAULT_SIMILARITY_THRESHOLD):
+        """ Returns (entry, similarity) for the cached question in the same scope whose embedding is
+            closest to embedding, if its cosine similarity reaches threshold; otherwise (None, similarity).
+        """
+        with self._lock:
+            if not self._loaded: self._load()
+            key, similarity = self._index.nearest(fingerprint(scope, embedding_model), embedding)
+            if key is None or similarity < threshold:
+                return None, similarity
+            self._entries.move_to_end(key)
+            return self._entries[key], similarity
+
+    def resize(self, max_entries):
+        with self._lock:
+            self.max_entries = max_entries
+            if self._loaded: self._evict()
+
+    async def coalesce(self, key, factory, on_delta=None, reset_stream=None, on_status=None):
+        """ Awaits factory(on_delta, reset_stream, on_status) once for every concurrent caller with the
+            same key (must run on one event loop). The shared call relays streamed text, stream resets
+            and status notices to every caller; one that joins mid-stream first gets the text so far.
+            It only streams when its first caller asked to. Token usage and Gemini chat sessions are
+            only updated for the first caller: the call spent no tokens for the others, and their
+            Gemini session is rebuilt from the history on their next request.
+            The shared call is only cancelled when every caller waiting on it has been cancelled.
+        """
+        shared = self._inflight.get(key)
+        if shared is None:
+            shared = self._inflight[key] = _SharedCall()
+            shared.task = asyncio.ensure_future(factory(shared.on_delta if on_delta else None, shared.reset_stream, shared.on_status))
+            shared.task.add_done_callback(lambda _: self._inflight.pop(key, None) if self._inflight.get(key) is shared else None)
+        else:
+            if debug_mode: print("DEBUG (Cache): Joining identical request already in flight.")
+            if on_delta and shared.streamed:
+                on_delta("".join(shared.streamed))
+
+        listener = (on_delta, reset_stream, on_status)
+        shared.listeners.append(listener)
+        shared.waiters += 1
+        try:
+            return await asyncio.shield(shared.task)
+        except asyncio.CancelledError:
+            if shared.waiters == 1:
+                # Forget the call before cancelling it, so an identical request starts afresh instead of joining it
+                if self._inflight.get(key) is shared:
+                    del self._inflight[key]
+                shared.task.cancel()
+            raise
+        finally:
+            shared.waiters -= 1
+            shared.listeners.remove(listener)
@@ -0,0 +1,279 @@
+import json
+import queue
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from core import ConversationEngine, TurnRecord
+
+debug_mode = False
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+TURN_TIMEOUT_S = 300
+SESSION_IDLE_TIMEOUT_S = 30 * 60
+MAX_REQUEST_BYTES = 1024 * 1024
+
+class SessionBusy(Exception):
+    """Raised when a message is sent to a session whose previous turn is still running."""
+
+class Session:
+    """ One client conversation on the server: a ConversationEngine plus the queue its events land on.
+        Only one turn runs at a time per session.
+    """
+
+    def __init__(self, session_id, conversation):
+        self.id = session_id
+        self.conversation = conversation
+        self.events = queue.Queue()
+        self.turn_lock = threading.Lock()
+        self.last_used = time.monotonic()
+        conversation.subscribe(lambda event, **data: self.events.put((event, data)))
+
+    def run_turn(self, message, on_event=None, timeout=TURN_TIMEOUT_S):
+        """ Sends message and waits for the turn to end, passing each event to on_event(event, data).
+            Returns the TurnRecord; raises SessionBusy or TimeoutError.
+        """
+        if not self.turn_lock.acquire(blocking=False):
+            raise SessionBusy(self.id)
+        try:
+            self.last_used = time.monotonic()
+            while not self.events.empty():
+                self.events.get_nowait()
+
+            record = TurnRecord(self.conversation)
+            if not self.conversation.send(message):
+                record.fail("Could not format the system prompt.")
+                return record
+
+            deadline = time.monotonic() + timeout
+            while True:
+                try:
+                    event, data = self.events.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    self.conversation.close()
+                    raise TimeoutError(f"No answer within {timeout}s.")
+                if on_event:
+                    on_event(event, data)
+                if record.add_event(event, **data):
+                    return record
+        finally:
+            self.last_used = time.monotonic()
+            self.turn_lock.release()
+
+    def close(self):
+        self.conversation.close()
+
+class AnswerBotServer(ThreadingHTTPServer):
+    """ Serves AnswerBot conversations over HTTP/JSON, with server-sent events for streaming.
+        Every session shares one dispatcher, so provider connections are pooled and the rate
+        limiter enforces one budget across all clients.
+
+        GET  /health                     server status
+        POST /sessions                   start a conversation -> {"session_id"}
+        POST /sessions/<id>/messages     {"message", "stream"} -> turn result (or an SSE stream)
+        DELETE /sessions/<id>            end a conversation
+        POST /ask                        {"question", "stream"} -> turn result of a one-off session
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, settings, prompts, dispatcher, engine, response_cache=None, turn_timeout=TURN_TIMEOUT_S):
+        super().__init__(address, AnswerBotRequestHandler)
+        self.settings = settings
+        self.prompts = prompts
+        self.dispatcher = dispatcher
+        self.engine = engine
+        self.response_cache = response_cache
+        self.turn_timeout = turn_timeout
+        self.sessions = {}
+        self._sessions_lock = threading.Lock()
+
+    def create_session(self, register=True):
+        """Starts a session; unless register is False it is kept for later messages until closed or idle."""
+        self.expire_idle_sessions()
+        conversation = ConversationEngine(self.settings, self.prompts, self.dispatcher, self.engine, self.response_cache)
+        session = Session(uuid.uuid4().hex, conversation)
+        if not register:
+            return session
+        with self._sessions_lock:
+            self.sessions[session.id] = session
+        if debug_mode: print(f"DEBUG (Server): Session {session.id} started ({len(self.sessions)} open).")
+        return session
+
+    def get_session(self, session_id):
+        with self._sessions_lock:
+            return self.sessions.get(session_id)
+
+    def close_session(self, session_id):
+        with self._sessions_lock:
+            session = self.sessions.pop(session_id, None)
+        if session:
+            session.close()
+        return session is not None
+
+    def expire_idle_sessions(self):
+        """Closes sessions that have not been used for SESSION_IDLE_TIMEOUT_S."""
+        cutoff = time.monotonic() - SESSION_IDLE_TIMEOUT_S
+        with self._sessions_lock:
+            expired = [session for session in self.sessions.values() if session.last_used < cutoff and not session.turn_lock.locked()]
+            for session in expired:
+                del self.sessions[session.id]
+        for session in expired:
+            session.close()
+            if debug_mode: print(f"DEBUG (Server): Session {session.id} expired.")
+
+    def close_all_sessions(self):
+        with self._sessions_lock:
+            sessions, self.sessions = list(self.sessions.values()), {}
+        for session in sessions:
+            session.close()
+
+class AnswerBotRequestHandler(BaseHTTPRequestHandler):
+    server_version = "AnswerBot"
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if debug_mode: super().log_message(format, *args)
+
+    def _send_json(self, status, payload=None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8") if payload is not None else b""
+        self.send_response(status)
+        if payload is not None:
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error_json(self, status, message):
+        self._send_json(status, {"error": message})
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length < 0:
+            raise ValueError("Negative Content-Length.")
+        if length > MAX_REQUEST_BYTES:
+            raise ValueError("Request body too large.")
+        if not length:
+            return {}
+        payload = json.loads(self.rfile.read(length).decode("utf-8"))
+        if not isinstance(payload, dict):
+            raise ValueError("Request body must be a JSON object.")
+        return payload
+
+    def _wants_stream(self, payload):
+        return bool(payload.get("stream")) or "text/event-stream" in (self.headers.get("Accept") or "")
+
+    def do_GET(self):
+        if self.path == "/health":
+            health = {
+                "status": "ok",
+                "sessions": len(self.server.sessions),
+                "api_type": self.server.settings.get("api_type"),
+                "model": self.server.settings.get("model")
+            }
+            pool = self.server.dispatcher.ollama_pools.get(self.server.settings.get("ollama_endpoint_url"))
+            if pool is not None:
+                health["ollama_endpoints"] = pool.status()
+            self._send_json(200, health)
+        else:
+            self._send_error_json(404, "Not found.")
+
+    def do_DELETE(self):
+        match = re.fullmatch(r"/sessions/(\w+)", self.path)
+        if not match:
+            self._send_error_json(404, "Not found.")
+        elif self.server.close_session(match.group(1)):
+            self._send_json(204)
+        else:
+            self._send_error_json(404, "Unknown session.")
+
+    def do_POST(self):
+        try:
+            payload = self._read_json()
+        except (ValueError, UnicodeDecodeError) as e:
+            # The body may not have been read, so the connection cannot carry another request
+            self.close_connection = True
+            self._send_error_json(400, f"Invalid request body: {e}")
+            return
+
+        if self.path == "/sessions":
+            self._send_json(201, {"session_id": self.server.create_session().id})
+            return
+
+        if self.path == "/ask":
+            # A one-off session that is never registered, so its history is freed with the reply
+            session = self.server.create_session(register=False)
+            try:
+                self._answer(session, payload.get("question"), payload)
+            finally:
+                session.close()
+            return
+
+        match = re.fullmatch(r"/sessions/(\w+)/messages", self.path)
+        if not match:
+            self._send_error_json(404, "Not found.")
+            return
+        session = self.server.get_session(match.group(1))
+        if session is None:
+            self._send_error_json(404, "Unknown session.")
+            return
+        self._answer(session, payload.get("message"), payload)
+
+    def _answer(self, session, message, payload):
+        if not isinstance(message, str) or not message.strip():
+            self._send_error_json(400, "A non-empty message is required.")
+            return
+        if self._wants_stream(payload):
+            self._stream_turn(session, message.strip())
+        else:
+            self._run_turn(session, message.strip())
+
+    def _run_turn(self, session, message):
+        try:
+            record = session.run_turn(message, timeout=self.server.turn_timeout)
+        except SessionBusy:
+            self._send_error_json(409, "This session is still answering the previous message.")
+            return
+        except TimeoutError as e:
+            self._send_error_json(504, str(e))
+            return
+        self._send_json(200, {"session_id": session.id, **record.to_dict()})
+
+    def _stream_turn(self, session, message):
+        """Runs a turn, relaying every engine event as a server-sent event, then a final 'result' event."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def write_event(event, data):
+            self.wfile.write(f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        try:
+            try:
+                record = session.run_turn(message, on_event=write_event, timeout=self.server.turn_timeout)
+                write_event("result", {"session_id": session.id, **record.to_dict()})
+            except SessionBusy:
+                write_event("result", {"session_id": session.id, "status": "error", "error": "This session is still answering the previous message."})
+            except TimeoutError as e:
+                write_event("result", {"session_id": session.id, "status": "error", "error": str(e)})
+        except (BrokenPipeError, ConnectionResetError):
+            if debug_mode: print(f"DEBUG (Server): Client left session {session.id} mid-turn, cancelling its request.")
+            session.close()
+
+def serve(settings, prompts, dispatcher, engine, response_cache=None, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """Runs the server until interrupted."""
+    server = AnswerBotServer((host, port), settings, prompts, dispatcher, engine, response_cache)
+    print(f"AnswerBot serving {settings.get('api_type')} ({settings.get('model')}) on http://{host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.close_all_sessions()
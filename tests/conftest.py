@@ -0,0 +1,49 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from providers import RateLimiter
+
+def scripted_reply(history):
+    """Answers like a model following the tool protocol: a short answer, then none_further once it succeeded."""
+    last = history[-1]["content"]
+    if "Successful" in last and "<user_response>" not in last:
+        return "<none_further></none_further>"
+    return "<short_answer><ans>42</ans></short_answer>"
+
+class FakeDispatcher:
+    """Stands in for ProviderDispatcher: replies with script(history) instead of calling a provider."""
+
+    def __init__(self, script=scripted_reply):
+        self.script = script
+        self.limiter = RateLimiter()
+        self.ollama_pools = {}
+        self.calls = 0
+
+    def get_rate_limiter(self, settings, api_type=None):
+        return self.limiter
+
+    async def request(self, settings, history, on_delta=None, reset_stream=None, tool_specs=None, allow_multiple=True,
+                      gemini_sessions=None, on_status=None, usage=None, affinity=None):
+        await asyncio.sleep(0.01)
+        self.calls += 1
+        if usage is not None:
+            usage["total_tokens"] = usage.get("total_tokens", 0) + 10
+        reply = self.script(history)
+        if on_delta:
+            on_delta(reply)
+        return reply, None, "Fake", "fake-1"
+
+    def reset(self):
+        pass
+
+@pytest.fixture
+def repo_dir(monkeypatch):
+    """Runs the test from the repository root, where the prompt files are read from."""
+    monkeypatch.chdir(ROOT)
+    return ROOT
@@ -0,0 +1,37 @@
+import asyncio
+
+from providers import AsyncEngine
+
+def test_only_slot_holders_count_against_max_concurrency():
+    engine = AsyncEngine(max_concurrency=1)
+    active, peak = [0], [0]
+
+    async def waiting_task():
+        await asyncio.sleep(0.2)
+
+    async def request():
+        async with engine.slot():
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+            await asyncio.sleep(0.02)
+            active[0] -= 1
+        return True
+
+    try:
+        engine.submit(waiting_task())
+        results = [engine.submit(request()) for _ in range(3)]
+        assert all(future.result(timeout=1) for future in results)
+        assert peak[0] == 1
+    finally:
+        engine.shutdown()
+
+def test_shutdown_lets_clean_up_tasks_finish():
+    engine = AsyncEngine()
+    closed = []
+
+    async def close_clients():
+        await asyncio.sleep(0.05)
+        closed.append(True)
+
+    engine.shutdown(wait_for=[engine.submit(close_clients())])
+    assert closed == [True]
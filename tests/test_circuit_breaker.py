@@ -0,0 +1,31 @@
+import time
+
+from providers import CircuitBreaker
+
+def open_breaker(reset_timeout=0.05):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=reset_timeout)
+    breaker.record_failure()
+    breaker.record_failure()
+    return breaker
+
+def test_opens_after_consecutive_failures():
+    breaker = open_breaker(reset_timeout=60)
+    assert not breaker.allow()
+
+def test_half_open_lets_exactly_one_trial_through():
+    breaker = open_breaker()
+    time.sleep(0.06)
+    assert [breaker.allow() for _ in range(3)] == [True, False, False]
+
+def test_trial_success_closes_and_failure_reopens():
+    breaker = open_breaker()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_success()
+    assert all(breaker.allow() for _ in range(3))
+
+    breaker = open_breaker()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert not breaker.allow()
@@ -0,0 +1,99 @@
+import asyncio
+import time
+
+from providers import OllamaEndpointPool
+
+# /api/tags and /api/ps of each fake server; None means the server does not answer
+NODES = {
+    "http://a:11434": {"tags": ["llama3:latest"], "ps": []},
+    "http://b:11434": {"tags": ["llama3:latest", "qwen:latest"], "ps": ["qwen:latest"]},
+    "http://c:11434": None,
+}
+
+class FakeResponse:
+    def __init__(self, names):
+        self.names = names
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return {"models": [{"name": name} for name in self.names]}
+
+class FakeClient:
+    def __init__(self, delay_s):
+        self.delay_s = delay_s
+
+    async def get(self, url, timeout=None):
+        await asyncio.sleep(self.delay_s)
+        base, _, path = url.rpartition("/api/")
+        node = NODES[base]
+        if node is None:
+            raise ConnectionError(f"could not connect to {base}")
+        return FakeResponse(node[path])
+
+class FakeRegistry:
+    def __init__(self, delay_s=0.0):
+        self.client = FakeClient(delay_s)
+
+    def get_client(self, api_type, api_key, endpoint, model):
+        return self.client
+
+def make_pool(delay_s=0.0):
+    return OllamaEndpointPool(list(NODES), FakeRegistry(delay_s))
+
+def probed_pool():
+    pool = make_pool()
+    asyncio.run(pool.refresh(force=True))
+    return pool
+
+def test_acquire_does_not_wait_for_probes():
+    async def scenario():
+        pool = make_pool(delay_s=1.0)
+        started = time.monotonic()
+        url = await pool.acquire("llama3")
+        elapsed = time.monotonic() - started
+        assert url in NODES
+        assert pool._refreshing is not None and not pool._refreshing.done()
+        await pool._refreshing
+        return pool, elapsed
+
+    pool, elapsed = asyncio.run(scenario())
+    assert elapsed < 0.5
+    assert [endpoint.healthy for endpoint in pool.endpoints] == [True, True, False]
+
+def test_skips_unhealthy_endpoints_and_ones_without_the_model():
+    pool = probed_pool()
+    assert {pool.select("llama3") for _ in range(10)} == {"http://a:11434", "http://b:11434"}
+    assert {pool.select("qwen") for _ in range(10)} == {"http://b:11434"}
+
+def test_affinity_is_kept_until_its_endpoint_is_much_busier():
+    async def scenario():
+        pool = make_pool()
+        await pool.refresh(force=True)
+        first = await pool.acquire("llama3", "conversation")
+        pool.release(first, "llama3", 0.5)
+        kept = [await pool.acquire("llama3", "conversation") for _ in range(2)]
+        for url in kept:
+            pool.release(url, "llama3", 0.5)
+        pool._get(first).in_flight = 5
+        moved = await pool.acquire("llama3", "conversation")
+        return first, kept, moved
+
+    first, kept, moved = asyncio.run(scenario())
+    assert kept == [first, first]
+    assert moved != first and moved != "http://c:11434"
+
+def test_prefers_the_least_loaded_endpoint():
+    pool = probed_pool()
+    pool._get("http://a:11434").in_flight = 3
+    assert pool.select("llama3") == "http://b:11434"
+    pool._get("http://a:11434").in_flight = 0
+    pool._get("http://b:11434").in_flight = 3
+    assert pool.select("llama3") == "http://a:11434"
+
+def test_failed_request_takes_endpoint_out_of_rotation():
+    pool = probed_pool()
+    pool.release("http://a:11434", "llama3", 1.0, ConnectionError("connection reset"))
+    assert not pool._get("http://a:11434").healthy
+    assert {pool.select("llama3") for _ in range(10)} == {"http://b:11434"}
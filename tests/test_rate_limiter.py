@@ -0,0 +1,39 @@
+import asyncio
+import time
+
+import pytest
+
+from providers import RateLimiter
+
+def test_concurrent_reservations_queue_behind_each_other():
+    limiter = RateLimiter(requests_per_minute=600)
+    for _ in range(600):
+        limiter.reserve()
+
+    async def scenario():
+        started = time.monotonic()
+        released = []
+
+        async def call():
+            wait_s, _ = limiter.reserve()
+            await asyncio.sleep(wait_s)
+            released.append(time.monotonic() - started)
+        await asyncio.gather(*(call() for _ in range(5)))
+        return sorted(released)
+
+    released = asyncio.run(scenario())
+    assert released == pytest.approx([0.1, 0.2, 0.3, 0.4, 0.5], abs=0.05)
+
+def test_min_interval_counts_from_the_last_start():
+    limiter = RateLimiter(min_interval=10)
+    assert limiter.reserve()[0] == 0
+    assert limiter.reserve()[0] == pytest.approx(10, abs=0.1)
+    assert limiter.reserve()[0] == pytest.approx(20, abs=0.1)
+
+def test_usage_settles_each_calls_own_reservation():
+    limiter = RateLimiter(tokens_per_minute=10000)
+    _, first = limiter.reserve(100)
+    _, second = limiter.reserve(5000)
+    assert (first, second) == (100, 5000)
+    limiter.record_usage(120, first)
+    assert limiter._token_level == pytest.approx(10000 - 120 - 5000, abs=5)
@@ -0,0 +1,48 @@
+import asyncio
+
+from response_cache import ResponseCache
+
+def test_coalesce_shares_one_call_and_relays_stream():
+    cache = ResponseCache(None)
+    calls = []
+
+    async def factory(on_delta, reset_stream, on_status):
+        calls.append(on_delta)
+        on_delta("Hel")
+        await asyncio.sleep(0.05)
+        on_status("retrying")
+        on_delta("lo")
+        return "Hello"
+
+    async def scenario():
+        first_text, second_text, statuses = [], [], []
+        first = asyncio.ensure_future(cache.coalesce("k", factory, first_text.append, None, statuses.append))
+        await asyncio.sleep(0.01)
+        second = await cache.coalesce("k", factory, second_text.append, None, statuses.append)
+        return await first, second, first_text, second_text, statuses
+
+    first, second, first_text, second_text, statuses = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert first == second == "Hello"
+    assert first_text == ["Hel", "lo"]
+    assert second_text == ["Hel", "lo"]
+    assert statuses == ["retrying", "retrying"]
+
+def test_request_after_last_waiter_cancelled_starts_afresh():
+    cache = ResponseCache(None)
+    calls = []
+
+    async def factory(on_delta, reset_stream, on_status):
+        calls.append(None)
+        await asyncio.sleep(0.05)
+        return len(calls)
+
+    async def scenario():
+        first = asyncio.ensure_future(cache.coalesce("k", factory))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        await asyncio.sleep(0)
+        # The cancelled call's done-callback has not run yet; this must not join it
+        return await cache.coalesce("k", factory)
+
+    assert asyncio.run(scenario()) == 2
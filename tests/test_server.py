@@ -0,0 +1,149 @@
+import asyncio
+import http.client
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+import core
+import server
+from conftest import FakeDispatcher
+from providers import AsyncEngine
+
+class BlockingDispatcher(FakeDispatcher):
+    """Holds every request until release is set, so a turn can be kept running."""
+
+    def __init__(self):
+        super().__init__()
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    async def request(self, settings, history, *args, **kwargs):
+        self.started.set()
+        while not self.release.is_set():
+            await asyncio.sleep(0.01)
+        return await super().request(settings, history, *args, **kwargs)
+
+@pytest.fixture
+def start_server(repo_dir):
+    """Starts an AnswerBotServer on a free port around a fake dispatcher; returns a call(method, path, body) helper."""
+    running = []
+
+    def start(dispatcher=None):
+        settings = dict(core.DEFAULT_SETTINGS, api_type="Ollama", model="llama3", response_cache=False)
+        engine = AsyncEngine(2)
+        httpd = server.AnswerBotServer(("127.0.0.1", 0), settings, core.PromptSet(), dispatcher or FakeDispatcher(), engine, turn_timeout=10)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        running.append((httpd, engine))
+        base = f"http://127.0.0.1:{httpd.server_port}"
+
+        def call(method, path, body=None, headers=None):
+            data = json.dumps(body).encode("utf-8") if body is not None else None
+            request = urllib.request.Request(base + path, data=data, method=method, headers={"Content-Type": "application/json", **(headers or {})})
+            try:
+                with urllib.request.urlopen(request, timeout=10) as response:
+                    return response.status, response.headers.get("Content-Type"), response.read().decode("utf-8")
+            except urllib.error.HTTPError as e:
+                return e.code, e.headers.get("Content-Type"), e.read().decode("utf-8")
+        call.base = base
+        return call
+
+    yield start
+    for httpd, engine in running:
+        httpd.shutdown()
+        httpd.server_close()
+        httpd.close_all_sessions()
+        engine.shutdown()
+
+def parse_events(body):
+    events = []
+    for block in body.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((fields["event"], json.loads(fields["data"])))
+    return events
+
+def test_health(start_server):
+    call = start_server()
+    status, _, body = call("GET", "/health")
+    assert status == 200
+    assert json.loads(body) == {"status": "ok", "sessions": 0, "api_type": "Ollama", "model": "llama3"}
+
+def test_ask_answers_in_a_new_session(start_server):
+    call = start_server()
+    status, content_type, body = call("POST", "/ask", {"question": "What is six times seven?"})
+    result = json.loads(body)
+    assert status == 200 and content_type.startswith("application/json")
+    assert result["status"] == "answered"
+    assert result["tool"] == "short_answer" and result["answer"] == "42"
+    assert result["session_id"]
+    assert json.loads(call("GET", "/health")[2])["sessions"] == 0
+
+def test_session_lifecycle(start_server):
+    call = start_server()
+    status, _, body = call("POST", "/sessions")
+    assert status == 201
+    session_id = json.loads(body)["session_id"]
+
+    for message in ("first question", "follow-up"):
+        status, _, body = call("POST", f"/sessions/{session_id}/messages", {"message": message})
+        assert status == 200
+        assert json.loads(body)["answer"] == "42"
+    assert json.loads(call("GET", "/health")[2])["sessions"] == 1
+
+    assert call("DELETE", f"/sessions/{session_id}")[0] == 204
+    assert call("POST", f"/sessions/{session_id}/messages", {"message": "gone?"})[0] == 404
+    assert call("DELETE", f"/sessions/{session_id}")[0] == 404
+
+def test_rejects_bad_requests(start_server):
+    call = start_server()
+    session_id = json.loads(call("POST", "/sessions")[2])["session_id"]
+    assert call("POST", f"/sessions/{session_id}/messages", {})[0] == 400
+    assert call("POST", f"/sessions/{session_id}/messages", {"message": "   "})[0] == 400
+    assert call("POST", "/sessions/unknown/messages", {"message": "hi"})[0] == 404
+    assert call("GET", "/nowhere")[0] == 404
+
+def test_rejects_negative_content_length(start_server):
+    call = start_server()
+    port = int(call.base.rsplit(":", 1)[1])
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    connection.putrequest("POST", "/ask")
+    connection.putheader("Content-Length", "-1")
+    connection.endheaders()
+    response = connection.getresponse()
+    assert response.status == 400
+    assert "Content-Length" in json.loads(response.read())["error"]
+    connection.close()
+
+def test_stream_relays_events_then_result(start_server):
+    call = start_server()
+    status, content_type, body = call("POST", "/ask", {"question": "What is six times seven?", "stream": True})
+    events = parse_events(body)
+    assert status == 200 and content_type.startswith("text/event-stream")
+    assert len(events) > 1
+    name, result = events[-1]
+    assert name == "result"
+    assert result["status"] == "answered" and result["answer"] == "42"
+    assert all(name != "result" for name, _ in events[:-1])
+
+def test_busy_session_returns_409(start_server):
+    dispatcher = BlockingDispatcher()
+    call = start_server(dispatcher)
+    session_id = json.loads(call("POST", "/sessions")[2])["session_id"]
+
+    first = {}
+    worker = threading.Thread(target=lambda: first.update(response=call("POST", f"/sessions/{session_id}/messages", {"message": "slow one"})))
+    worker.start()
+    try:
+        assert dispatcher.started.wait(5)
+        status, _, body = call("POST", f"/sessions/{session_id}/messages", {"message": "impatient"})
+        assert status == 409
+        assert "still answering" in json.loads(body)["error"]
+    finally:
+        dispatcher.release.set()
+        worker.join(10)
+
+    status, _, body = first["response"]
+    assert status == 200
+    assert json.loads(body)["answer"] == "42"
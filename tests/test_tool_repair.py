@@ -0,0 +1,17 @@
+from core import DEFAULT_PARAM_NAMES, DEFAULT_TOOL_NAMES, repair_tool_response
+
+def repair(text):
+    return repair_tool_response(text, DEFAULT_TOOL_NAMES, DEFAULT_PARAM_NAMES)
+
+def test_strips_prose_around_the_calls():
+    repaired, fixes = repair("Sure! <math_work><work>1+1</work></math_work>\n<math_answer><ans>2</ans></math_answer> Done.")
+    assert repaired == "<math_work><work>1+1</work></math_work>\n<math_answer><ans>2</ans></math_answer>"
+    assert fixes == ["text outside tool call"]
+
+def test_leaves_prose_between_calls_to_a_format_error():
+    assert repair("<short_answer><ans>A</ans></short_answer> or maybe <short_answer><ans>B</ans></short_answer>") == (None, [])
+
+def test_repairs_fence_and_unclosed_tag():
+    repaired, fixes = repair("```xml\n<SHORT_ANSWER><ans>42</ans>\n```")
+    assert repaired == "<short_answer><ans>42</ans>\n</short_answer>"
+    assert fixes == ["code fence", "tag case", "unclosed <short_answer>"]